@@ -9,14 +9,13 @@ of images distinguished by the model.
 import ttk
 import Tkinter as tk
 import tkFileDialog as tkfd
+import threading
+import Queue
 from datetime import datetime
-from os import mkdir, listdir
-from os.path import exists, join, basename
-from shutil import copyfile
-from scipy.io import loadmat
-from sklearn.kernel_approximation import AdditiveChi2Sampler
-from cPickle import load
-from birdid_utils import *
+from os.path import join, expanduser
+from birdid_utils import get_imgfiles
+from birdid_classify import Classifier, classifyImages, Cancelled
+from birdid_registry import ModelRegistry
 
 VERBOSE = True
 
@@ -47,9 +46,23 @@ class Application(ttk.Frame):
     destDirBrowseTitle = 'Choose directory for classified images'
 
     classifyButtonText = 'Classify'
+    cancelButtonText = 'Cancel'
 
     statusLabelText = 'Status'
 
+    # Histograms of previously classified images are kept here, keyed by
+    # image content and model, so re-running on a folder only processes
+    # new images
+    histCacheDir = join(expanduser('~'), '.birdid', 'histcache')
+    histCacheMaxBytes = 2 << 30
+
+    # Worker processes used for feature extraction. Classification itself
+    # runs on a background thread either way, so the window stays live
+    classifyJobs = 1
+
+    # How often (ms) the GUI picks up messages from the classification thread
+    pollInterval = 100
+
     # Text field width
     entryWidth = 40
 
@@ -211,6 +224,34 @@ class Application(ttk.Frame):
         row += 1
         col = 0
 
+        # Progress of a running classification
+        self.progressBar = ttk.Progressbar(self, orient=tk.HORIZONTAL,
+                                           mode='determinate')
+        self.progressBar.grid(
+            row=row, column=col, columnspan=4,
+            padx=self.widgetPadX, pady=self.widgetPadY, sticky=tk.W+tk.E)
+        col += 4
+
+        self.cancelButton = ttk.Button(
+            self, text=self.cancelButtonText,
+            command=self.cancelClassification, state='disabled')
+        self.cancelButton.grid(
+            row=row, column=col,
+            padx=self.widgetPadX, pady=self.widgetPadY)
+
+        row += 1
+        col = 0
+
+        self.progressText = tk.StringVar()
+        self.progressText.set('')
+        self.progressLabel = ttk.Label(self, textvariable=self.progressText)
+        self.progressLabel.grid(
+            row=row, column=col, columnspan=5,
+            padx=self.widgetPadX, sticky=tk.W)
+
+        row += 1
+        col = 0
+
         separator = ttk.Separator(self, orient=tk.HORIZONTAL)
         separator.grid(
             row=row, column=col, columnspan=5,
@@ -252,6 +293,7 @@ class Application(ttk.Frame):
 
     def updateStatus(self, message):
         self.statusField.insert('end', message + '\n')
+        self.statusField.see('end')
         return
 
     def modelDirBrowse(self):
@@ -259,44 +301,32 @@ class Application(ttk.Frame):
                                     self.modelDirBrowseTitle)
 
         if len(dirname) > 0:
-            # Update the combobox of available identifiers from the contents
-            # of directory dirname
-            fileList = listdir(dirname)
-
-            # Debug - print out list of files in the model dir
+            # Update the combobox of available identifiers from the model
+            # registry of directory dirname, which only looks at files
+            # that changed since it was last opened. Hashing them would
+            # freeze the window on a slow share; that is left to
+            # birdid_registry.py --validate
+            registry = ModelRegistry(dirname, hashFiles=False)
+            registry.update()
             if VERBOSE:
                 self.updateStatus('Selected model folder ' + dirname)
-                print 'Files in model directory'
-                for fname in fileList:
-                    print fname
-
-            # Put file names into appropriate sequences
-            # assumes filenames are presented in lexicographic ordering
-            identifier = ''
-            prefix = ''
+
             self.allPrefixes = {}
             self.allIdentifiers = [self.modelSelectDefault]
-            self.allHists = []
-            self.allVocabs = []
-            self.allModels = []
-
-            for fname in fileList:
-                if fname.find('hists') >= 0:
-                    identifier = fname[0:fname.index('-hists')]
+            for model in registry.models():
+                identifier = model['identifier']
+                if not model['complete']:
+                    self.updateStatus('Skipping model ' + model['prefix'] + '-' +
+                                      identifier + ': ' +
+                                      '; '.join(model['problems']))
+                    continue
+                if identifier not in self.allPrefixes:
                     self.allIdentifiers.append(identifier)
-                    self.allHists.append(fname)
                     self.allPrefixes[identifier] = [self.modelSelectDefault]
-                elif fname.find('vocab') >= 0:
-                    self.allVocabs.append(fname)
-                elif fname.find('model') >= 0:
-                    self.allModels.append(fname)
-                    identifier = fname[fname.index('-')+1:fname.index('-model')]
-                    prefix = fname[0:fname.index('-')]
-                    if self.debug:
-                        print 'Found prefix ' + prefix + ' for ID ' + \
-                            identifier
-                    self.allPrefixes[identifier].append(prefix)
-
+                if self.debug:
+                    print 'Found prefix ' + model['prefix'] + ' for ID ' + \
+                        identifier
+                self.allPrefixes[identifier].append(model['prefix'])
 
             # Update the combo box with the list of available identifiers
             self.modelIdentifierCombo.configure(
@@ -322,10 +352,11 @@ class Application(ttk.Frame):
 
     def handleModelSelection(self, evt):
         self.selectedIdentifier = evt.widget.get()
-        print 'Available prefixes: %s' % \
-            str(self.allPrefixes[self.selectedIdentifier])
-        self.modelPrefixCombo.configure(
-            values=self.allPrefixes[self.selectedIdentifier], state='Enabled')
+        # modelSelectDefault itself has no prefixes
+        prefixes = self.allPrefixes.get(self.selectedIdentifier,
+                                        [self.modelSelectDefault])
+        print 'Available prefixes: %s' % str(prefixes)
+        self.modelPrefixCombo.configure(values=prefixes, state='Enabled')
         # Debugging
         if self.debug:
             print 'Called handleModelSelection()'
@@ -343,107 +374,92 @@ class Application(ttk.Frame):
         return
 
     def classifyImages(self):
-        # Load configuration from result of training so we're working with
-        # the same parameters
-        resultFileName = self.selectedPrefix + '-' + self.selectedIdentifier + \
-            '-result'
-        resultPath = join(self.modelDirEntryText.get(), resultFileName)
-
-        with open(resultPath, 'rb') as fp:
-            conf = load(fp)
-            classes = conf.classes
-            if VERBOSE:
-                self.updateStatus(
-                    str(datetime.now()) + " Found classes " + str(classes))
-
-        # The Model class is just a subset of the Configuration class wth
-        # the set of categories added in. The categories aren't needed for
-        # this preprocessing, since they only have an impact on the final
-        # classification. We do need the class names to decide how to name
-        # the destination folders, however.
-        model = Model([], conf)
-
-        # Load existing model for classification
-        modelFileName = self.selectedPrefix + '-' + self.selectedIdentifier + \
-            '-model.py.mat'
-        modelPath = join(self.modelDirEntryText.get(), modelFileName)
-
-        if VERBOSE:
-            self.updateStatus(str(datetime.now()) + ' Loading model from ' +
-                              modelFileName)
-
-        with open(modelPath, 'rb') as fp:
-            # SVM classifier trained on similar data
-            clf = load(fp)
-
-        # Preprocess images to be classified as training model images were
-        # preprocessed
-
-        imgPath = self.imageDirEntryText.get()
-
-        # imgs contains the filenames of the files in the requested folder
-        imgs = get_imgfiles(imgPath, conf.extensions)
-
-        # Use vocabulary extracted from training images
-        model.vocab = loadmat(join(self.modelDirEntryText.get(), self.selectedIdentifier+"-vocab.py.mat"))['vocab'] #changed loadmat(conf.vocabPath)
-
-        # Extract vocabulary from images to be classified. This is wrong, as 
-        # I suspected. Results in everything being classified as a Cardinal.
-        # model.vocab = birdid_utils.trainVocab(range(len(imgs)), imgs, conf)
-
-        # Compute spatial histograms from test images
-        self.updateStatus(str(datetime.now()) + " Computing spatial histograms")
-        hists = computeHistograms(imgs, model, conf)
-
-        # Compute feature map of image data
-        self.updateStatus(str(datetime.now()) + " Computing feature map")
-        transformer = AdditiveChi2Sampler()
-        histst = transformer.fit_transform(hists)
-
-        # Classify images using trained model. predicted_clases is an array
-        # containing the index for the predicted class of each image
-        self.updateStatus(str(datetime.now()) + " Classifying images")
-        predicted_classes = clf.predict(histst)
-
-        # Make copies of the classified images in a new folder structure
-        # reflecting the identified classes
-
-        # Check that top level destination folder exists and create if not.
-        self.updateStatus(
-            str(datetime.now()) + " Creating destination folders in")
-        destFolder = self.destDirEntryText.get()
-        self.updateStatus("    " + destFolder)
-        if not exists(destFolder):
-            create_dir(destFolder)
-
-        pathToClass = []
-        i = 0
-
-        for className in classes:
-            pathToClass.append(join(destFolder, str(className)))
-            self.updateStatus("    " + pathToClass[i])
-            if not exists(pathToClass[i]):
-                create_dir(pathToClass[i])
-            i += 1
-
-        self.updateStatus("Copying images to destination folders")
-        for i in range(len(imgs)):
-            destfn = join(pathToClass[predicted_classes[i]], basename(imgs[i]))
-            # if self.debug:
-            #     print 'imgPath = ' + imgPath
-            #     print 'pathToClass[i] = ' + pathToClass[predicted_classes[i]]
-            copyfile(imgs[i], destfn)
+        # Tk is not thread safe, so everything the worker thread needs is read
+        # here and everything it reports comes back through self.events
+        args = (self.modelDirEntryText.get(), self.selectedIdentifier,
+                self.selectedPrefix, self.imageDirEntryText.get(),
+                self.destDirEntryText.get())
+        self.events = Queue.Queue()
+        self.cancelEvent = threading.Event()
+        self.classifyButton.configure(state='disabled')
+        self.cancelButton.configure(state='normal')
+        self.progressBar.configure(value=0, maximum=1)
+        self.progressText.set('')
+
+        worker = threading.Thread(target=self.classifyWorker, args=args)
+        worker.daemon = True
+        worker.start()
+        self.after(self.pollInterval, self.pollEvents)
+        return
+
+    def classifyWorker(self, modelDir, identifier, prefix, imgPath, destFolder):
+        """ Runs on a background thread; talks to the GUI only via self.events """
+        def status(message):
+            self.events.put(('status', message))
+
+        def progress(done, total, rate, eta):
+            self.events.put(('progress', (done, total, rate, eta)))
+
+        try:
+            classifier = Classifier(modelDir, identifier, prefix,
+                                    status=status if VERBOSE else None)
+
+            # imgs contains the filenames of the files in the requested folder
+            imgs = get_imgfiles(imgPath, classifier.conf.extensions)
+
+            # Extract vocabulary from images to be classified. This is wrong, as 
+            # I suspected. Results in everything being classified as a Cardinal.
+            # model.vocab = birdid_utils.trainVocab(range(len(imgs)), imgs, conf)
+
+            cache = classifier.openCache(self.histCacheDir, self.histCacheMaxBytes)
+            classifyImages(classifier, imgs, destFolder, jobs=self.classifyJobs,
+                           cache=cache, status=status, progress=progress,
+                           cancel=self.cancelEvent)
+        except Cancelled:
+            self.events.put(('finished', str(datetime.now()) + ' Cancelled'))
+        except Exception as e:
+            self.events.put(('finished', str(datetime.now()) + ' Failed: ' +
+                             repr(e)))
+        else:
+            self.events.put(('finished', str(datetime.now()) + ' Done'))
+        return
 
+    def pollEvents(self):
+        finished = False
+        try:
+            while True:
+                kind, value = self.events.get_nowait()
+                if kind == 'status':
+                    self.updateStatus(value)
+                elif kind == 'progress':
+                    self.showProgress(*value)
+                elif kind == 'finished':
+                    self.updateStatus(value)
+                    finished = True
+        except Queue.Empty:
+            pass
+
+        if finished:
+            self.classifyButton.configure(state='normal')
+            self.cancelButton.configure(state='disabled')
+        else:
+            self.after(self.pollInterval, self.pollEvents)
         return
 
-# Create a directory if it doesn't already exist
-def create_dir(dirName):
-    try:
-        mkdir(dirName)
-    except OSError:
-        pass
+    def showProgress(self, done, total, rate, eta):
+        self.progressBar.configure(value=done, maximum=max(total, 1))
+        text = '{0} of {1} images, {2:.2f} images/s'.format(done, total, rate)
+        if eta is not None:
+            text += ', {0:.0f} s remaining'.format(eta)
+        self.progressText.set(text)
+        return
 
-    return
+    def cancelClassification(self):
+        # Takes effect between images
+        self.cancelEvent.set()
+        self.cancelButton.configure(state='disabled')
+        self.updateStatus(str(datetime.now()) + ' Cancelling...')
+        return
 
 ###############
 # Main Program
@@ -0,0 +1,602 @@
+#!/usr/bin/env python
+""" Benchmarks and sanity checks for the BirdID feature pipeline
+
+Everything here runs on synthetic data, so no trained model or image
+folder is needed.
+
+    python birdid_bench.py quantizer --words 600 --descriptors 20000
+    python birdid_bench.py pyramid --width 640 --height 480
+    python birdid_bench.py decode --width 2592 --height 1944 --count 10
+    python birdid_bench.py sparse --images 200 --descriptors 20000
+    python birdid_bench.py suite --count 20 --output after.json --baseline before.json
+    python birdid_bench.py coldstart MODELDIR IDENTIFIER PREFIX
+    python birdid_bench.py imports --budget 0.3
+
+suite times every stage of classification separately and writes the
+results as JSON, so runs on two commits can be compared; with --baseline
+it exits non-zero if a stage got slower than --threshold allows.
+"""
+
+import argparse
+import json
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy
+from os.path import abspath, dirname, join
+from shutil import copyfile
+from scipy.cluster.vq import vq
+from scipy.misc import imread
+from birdid_utils import Configuration, Model, PHOWOptions, quantizeDescriptors, \
+    quantizeDescriptorsBatch, \
+    getSpatialHistogram, standardizeImage, loadImage, decodeImage, pilImage, \
+    getPhowFeatures, histogramLength, computeHistograms, computeHistogramsMulti
+
+
+def syntheticConfiguration(quantizer='vq', kdtreeEps=0.0):
+    """ The feature settings of a default Configuration """
+    # Configuration.__init__ creates dataDir on disk, which a benchmark
+    # has no business doing
+    conf = Configuration.__new__(Configuration)
+    conf.phowOpts = PHOWOptions(Verbose=False, Sizes=[2, 4, 6, 8], Step=3)
+    conf.numSpatialX = numpy.array([2, 4])
+    conf.numSpatialY = numpy.array([2, 4])
+    conf.quantizer = quantizer
+    conf.kdtreeEps = kdtreeEps
+    conf.numCore = 1
+    return conf
+
+
+def syntheticModel(numWords=600, quantizer='vq', kdtreeEps=0.0, seed=0):
+    """ Model with a random uint8 vocabulary shaped like vl_ikmeans output """
+    conf = syntheticConfiguration(quantizer, kdtreeEps)
+    rng = numpy.random.RandomState(seed)
+    vocab = rng.randint(0, 256, size=(128, numWords)).astype('uint8')
+    return Model([], conf, vocab)
+
+
+def syntheticDescriptors(vocab, numDescriptors, noise=20.0, seed=1):
+    """ uint8 descriptors scattered around randomly chosen visual words """
+    rng = numpy.random.RandomState(seed)
+    centres = vocab[:, rng.randint(0, vocab.shape[1], numDescriptors)]
+    descrs = centres + rng.normal(0, noise, centres.shape)
+    return numpy.clip(numpy.rint(descrs), 0, 255).astype('uint8')
+
+
+def compareQuantizers(model, descrs, epsValues=(0.0,)):
+    """ Agreement of the kdtree quantizer with vq for each eps value
+
+    Returns a list of (eps, agreement, seconds) tuples, with vq itself
+    reported first as eps None. Agreement is the fraction of descriptors
+    assigned to the same visual word as vq.
+    """
+    model.quantizer = 'vq'
+    start = time.time()
+    reference = quantizeDescriptors(model, descrs)
+    results = [(None, 1.0, time.time() - start)]
+
+    model.quantizer = 'kdtree'
+    model.kdtree()  # built once per vocabulary, so keep it out of the timing
+    for eps in epsValues:
+        model.kdtreeEps = eps
+        start = time.time()
+        words = quantizeDescriptors(model, descrs)
+        elapsed = time.time() - start
+        results.append((eps, numpy.mean(words == reference), elapsed))
+    return results
+
+
+def compareGemm(model, descrs, numImages):
+    """ Throughput of the gemm quantizer against vq, per image and batched
+
+    descrs is split into numImages equal parts, quantized one image at a
+    time with vq and gemm and then all at once with
+    quantizeDescriptorsBatch. Returns a list of (name, agreement, seconds)
+    tuples with vq first.
+    """
+    images = numpy.array_split(descrs, numImages, axis=1)
+    model.quantizer = 'vq'
+    start = time.time()
+    reference = numpy.concatenate([quantizeDescriptors(model, d) for d in images])
+    results = [('vq', 1.0, time.time() - start)]
+
+    model.quantizer = 'gemm'
+    model.gemmVocab('float32')  # built once per vocabulary, like the kd-tree
+    start = time.time()
+    words = numpy.concatenate([quantizeDescriptors(model, d) for d in images])
+    results.append(('gemm', numpy.mean(words == reference), time.time() - start))
+    start = time.time()
+    words = numpy.concatenate(quantizeDescriptorsBatch(model, images))
+    results.append(('gemm batch', numpy.mean(words == reference), time.time() - start))
+    return results
+
+
+def syntheticFrames(width, height, sizes=(2, 4, 6, 8), step=3):
+    """ Frames laid out on the dense grid vl_phow produces for one image """
+    margin = 3 * max(sizes) / 2
+    xs = numpy.arange(margin, width - margin, step, dtype='float64')
+    ys = numpy.arange(margin, height - margin, step, dtype='float64')
+    x, y = numpy.meshgrid(xs, ys)
+    frames = [numpy.vstack([x.ravel(), y.ravel(), numpy.ones(x.size),
+                            size * numpy.ones(x.size)]) for size in sizes]
+    return numpy.hstack(frames)
+
+
+def referenceSpatialHistogram(frames, words, width, height, numWords, numSpatialX):
+    """ The per-level numpy.histogram construction getSpatialHistogram replaced """
+    hist = []
+    for n in numSpatialX:
+        binsx, _ = vq(frames[0, :], numpy.linspace(0, width, n))
+        binsy, _ = vq(frames[1, :], numpy.linspace(0, height, n))
+        number_of_bins = n * n * numWords
+        temp = numpy.arange(number_of_bins).reshape([n, n, numWords])
+        hist_temp, _ = numpy.histogram(temp[binsx, binsy, words],
+                                       bins=range(number_of_bins + 1),
+                                       density=True)
+        hist.append(hist_temp)
+    hist = numpy.hstack(hist)
+    return numpy.array(hist, 'float32') / sum(hist)
+
+
+def runPyramid(args):
+    numSpatialX = numpy.array(args.spatial)
+    frames = syntheticFrames(args.width, args.height)
+    rng = numpy.random.RandomState(0)
+    words = rng.randint(0, args.words, frames.shape[1]).astype('int32')
+
+    start = time.time()
+    reference = referenceSpatialHistogram(frames, words, args.width,
+                                          args.height, args.words, numSpatialX)
+    referenceTime = time.time() - start
+    start = time.time()
+    hist = getSpatialHistogram(frames, words, args.width, args.height,
+                               args.words, numSpatialX)
+    histTime = time.time() - start
+
+    difference = numpy.abs(hist - reference).max()
+    print('{0} descriptors, {1} bins'.format(frames.shape[1], len(hist)))
+    print('histogram  {0:.4f} s'.format(referenceTime))
+    print('bincount   {0:.4f} s'.format(histTime))
+    print('max abs difference {0:.3g}'.format(difference))
+    if difference > args.tolerance:
+        raise SystemExit('pyramid histograms differ by more than {0}'.format(
+            args.tolerance))
+
+
+def syntheticImages(directory, width, height, count, extension='.jpg', seed=2):
+    """ Write count smooth random colour images and return their paths """
+    Image = pilImage()
+    rng = numpy.random.RandomState(seed)
+    paths = []
+    for ii in range(count):
+        # a coarse random field scaled up looks more like a photo than noise
+        coarse = rng.randint(0, 256, size=(height // 32 + 1, width // 32 + 1, 3))
+        img = Image.fromarray(coarse.astype('uint8')).resize((width, height),
+                                                            Image.BILINEAR)
+        paths.append(join(directory, 'synthetic_{0:04d}{1}'.format(ii, extension)))
+        img.save(paths[-1])
+    return paths
+
+
+def runDecode(args):
+    directory = tempfile.mkdtemp()
+    try:
+        paths = args.images or syntheticImages(directory, args.width,
+                                               args.height, args.count)
+        began = time.time()
+        reference = [standardizeImage(imread(path)) for path in paths]
+        oldTime = (time.time() - began) / len(paths)
+        began = time.time()
+        loaded = [loadImage(path) for path in paths]
+        newTime = (time.time() - began) / len(paths)
+    finally:
+        shutil.rmtree(directory)
+
+    difference = max(numpy.abs(a - b).mean() for a, b in zip(reference, loaded))
+    print('{0} images'.format(len(paths)))
+    print('imread + standardizeImage  {0:.4f} s per image'.format(oldTime))
+    print('loadImage                  {0:.4f} s per image'.format(newTime))
+    print('largest mean abs pixel difference {0:.4f}'.format(difference))
+
+
+def _nbytes(hists):
+    if hasattr(hists, 'indptr'):
+        return hists.data.nbytes + hists.indices.nbytes + hists.indptr.nbytes
+    return hists.nbytes
+
+
+def runSparse(args):
+    from sklearn.kernel_approximation import AdditiveChi2Sampler
+    from birdid_utils import stackHistograms
+    numSpatialX = numpy.array([2, 4])
+    rng = numpy.random.RandomState(0)
+    images = []
+    for ii in range(args.images):
+        frames = numpy.vstack([rng.rand(args.descriptors) * args.width,
+                               rng.rand(args.descriptors) * args.height])
+        # visual words of real images are far from uniformly used
+        words = (rng.zipf(args.zipf, args.descriptors) - 1) % args.words
+        images.append((frames, words))
+    numBins = args.words * sum(n * n for n in numSpatialX)
+    weights = rng.normal(size=(args.classes, 3 * numBins)).astype('float32')
+
+    print('{0:>7} {1:>10} {2:>10} {3:>10} {4:>10}'.format(
+        '', 'MB', 'hist s', 'map s', 'decide s'))
+    for sparse in (False, True):
+        began = time.time()
+        hists = stackHistograms([getSpatialHistogram(
+            frames, words, args.width, args.height, args.words, numSpatialX,
+            sparse) for frames, words in images])
+        histTime = time.time() - began
+        began = time.time()
+        histst = AdditiveChi2Sampler().fit_transform(hists)
+        mapTime = time.time() - began
+        began = time.time()
+        histst.dot(weights.T)
+        decideTime = time.time() - began
+        print('{0:>7} {1:>10.1f} {2:>10.3f} {3:>10.3f} {4:>10.3f}'.format(
+            'sparse' if sparse else 'dense',
+            (_nbytes(hists) + _nbytes(histst)) / float(1 << 20),
+            histTime, mapTime, decideTime))
+
+
+def runQuantizer(args):
+    model = syntheticModel(args.words)
+    descrs = syntheticDescriptors(model.vocab, args.descriptors, args.noise)
+    epsValues = sorted(set([0.0] + list(args.eps)))
+    results = compareQuantizers(model, descrs, epsValues)
+    print('{0:>12} {1:>10} {2:>10}'.format('quantizer', 'agreement', 'seconds'))
+    for eps, agreement, elapsed in results:
+        name = 'vq' if eps is None else 'kd eps={0:g}'.format(eps)
+        print('{0:>12} {1:>9.2f}% {2:>10.3f}'.format(name, 100 * agreement, elapsed))
+    exact = results[1][1]
+    if exact < args.min_agreement:
+        raise SystemExit('exact kdtree agreement {0:.4f} below {1}'.format(
+            exact, args.min_agreement))
+
+    # Same descriptors as --images images
+    print('\n{0:>12} {1:>10} {2:>10} {3:>12}'.format(
+        'quantizer', 'agreement', 'seconds', 'descr/s'))
+    for name, agreement, elapsed in compareGemm(model, descrs, args.images):
+        print('{0:>12} {1:>9.2f}% {2:>10.3f} {3:>12.0f}'.format(
+            name, 100 * agreement, elapsed, args.descriptors / elapsed))
+        if agreement < 1.0:
+            raise SystemExit('{0} assigned {1:.4f}% of the descriptors to other '
+                             'words than vq'.format(name, 100 * (1 - agreement)))
+
+
+def syntheticClassifier(numBins, numClasses=9, sampleSteps=2, seed=3):
+    """ LinearSVC with random weights for chi2-mapped histograms of numBins """
+    from sklearn.svm import LinearSVC
+    rng = numpy.random.RandomState(seed)
+    clf = LinearSVC()
+    clf.coef_ = rng.normal(size=(numClasses, (2 * sampleSteps - 1) * numBins))
+    clf.intercept_ = rng.normal(size=numClasses)
+    clf.classes_ = numpy.arange(numClasses)
+    return clf
+
+
+SUITE_STAGES = ('decode', 'standardize', 'phow', 'quantize', 'pyramid',
+                'featuremap', 'predict', 'fused_predict', 'copy', 'histograms')
+
+
+def timeSuite(paths, model, conf, clf, destDir, jobs=1):
+    """ Seconds spent in each stage of classifying the images in paths
+
+    The per-image stages run one after the other on every image, as
+    getImageDescriptor does; featuremap, predict and fused_predict run
+    once on all histograms. histograms is computeHistograms (or
+    computeHistogramsMulti with jobs > 1) end to end. Returns the stage
+    times and the total number of descriptors.
+    """
+    from sklearn.kernel_approximation import AdditiveChi2Sampler
+    from birdid_classify import Chi2LinearPredictor
+    seconds = dict((stage, 0.0) for stage in SUITE_STAGES)
+    numWords = model.vocab.shape[1]
+    hists = []
+    numDescriptors = 0
+
+    def timed(stage, function, *args):
+        began = time.time()
+        result = function(*args)
+        seconds[stage] += time.time() - began
+        return result
+
+    for path in paths:
+        raw = timed('decode', decodeImage, path)
+        im = timed('standardize', standardizeImage, raw)
+        frames, descrs = timed('phow', getPhowFeatures, im, conf.phowOpts)
+        words = timed('quantize', quantizeDescriptors, model, descrs)
+        hists.append(timed('pyramid', getSpatialHistogram, frames, words,
+                           im.shape[1], im.shape[0], numWords, model.numSpatialX))
+        numDescriptors += descrs.shape[1]
+        timed('copy', copyfile, path, join(destDir, 'copy.jpg'))
+    hists = numpy.vstack(hists)
+
+    histst = timed('featuremap', AdditiveChi2Sampler().fit_transform, hists)
+    timed('predict', clf.predict, histst)
+    predictor = Chi2LinearPredictor(clf)
+    timed('fused_predict', predictor.predict, hists)
+
+    if jobs > 1:
+        conf.numCore = jobs
+        timed('histograms', computeHistogramsMulti, paths, model, conf)
+    else:
+        timed('histograms', computeHistograms, paths, model, conf)
+    return seconds, numDescriptors
+
+
+def compareToBaseline(results, baseline, threshold, noiseFloor):
+    """ Stages of results more than threshold slower than in baseline
+
+    Returns (stage, baseline seconds per image, seconds per image) for
+    each regression. Stages faster than noiseFloor seconds per image in
+    both runs are too short to time reliably and are not compared.
+    """
+    regressions = []
+    for stage, timing in sorted(results['stages'].items()):
+        if stage not in baseline['stages']:
+            continue
+        before = baseline['stages'][stage]['seconds_per_image']
+        after = timing['seconds_per_image']
+        if max(before, after) < noiseFloor:
+            continue
+        if after > before * (1.0 + threshold):
+            regressions.append((stage, before, after))
+    return regressions
+
+
+def runSuite(args):
+    conf = syntheticConfiguration(args.quantizer)
+    model = syntheticModel(args.words, args.quantizer)
+    clf = syntheticClassifier(histogramLength(model), args.classes)
+    directory = tempfile.mkdtemp()
+    try:
+        paths = syntheticImages(directory, args.width, args.height, args.count)
+        # best of the repeats per stage; the first run also warms the disk
+        # cache and any lazily built state
+        best = None
+        for repeat in range(args.repeats):
+            seconds, numDescriptors = timeSuite(paths, model, conf, clf,
+                                                directory, args.jobs)
+            if best is None:
+                best = seconds
+            else:
+                best = dict((stage, min(best[stage], seconds[stage]))
+                            for stage in best)
+    finally:
+        shutil.rmtree(directory)
+
+    perImage = sum(best[stage] for stage in SUITE_STAGES if stage != 'histograms')
+    results = {
+        'settings': {'width': args.width, 'height': args.height,
+                     'count': args.count, 'words': args.words,
+                     'classes': args.classes, 'quantizer': args.quantizer,
+                     'jobs': args.jobs, 'repeats': args.repeats},
+        'environment': {'python': platform.python_version(),
+                        'numpy': numpy.__version__,
+                        'machine': platform.machine(),
+                        'node': platform.node()},
+        'descriptors_per_image': numDescriptors / float(args.count),
+        'images_per_second': args.count / best['histograms'] if best['histograms'] else 0.0,
+        'stages': dict((stage, {'seconds': best[stage],
+                                'seconds_per_image': best[stage] / args.count})
+                       for stage in SUITE_STAGES)}
+
+    print('{0} images of {1}x{2}, {3:.0f} descriptors each'.format(
+        args.count, args.width, args.height, results['descriptors_per_image']))
+    print('{0:>14} {1:>12} {2:>7}'.format('stage', 'ms/image', 'share'))
+    for stage in SUITE_STAGES:
+        share = '' if stage == 'histograms' else \
+            '{0:.1f}%'.format(100 * best[stage] / perImage)
+        print('{0:>14} {1:>12.2f} {2:>7}'.format(
+            stage, 1000 * results['stages'][stage]['seconds_per_image'], share))
+    print('{0:.2f} images/s through computeHistograms'.format(
+        results['images_per_second']))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        if baseline['settings'] != results['settings']:
+            print('warning: baseline was run with different settings')
+        regressions = compareToBaseline(results, baseline, args.threshold,
+                                        args.noise_floor)
+        for stage, before, after in regressions:
+            print('REGRESSION {0}: {1:.2f} -> {2:.2f} ms/image (+{3:.0f}%)'.format(
+                stage, 1000 * before, 1000 * after, 100 * (after / before - 1)))
+        if regressions:
+            raise SystemExit('{0} stages slower than the baseline by more '
+                             'than {1:.0f}%'.format(len(regressions),
+                                                   100 * args.threshold))
+
+
+# Run in a fresh interpreter, so imports and file reads are all counted
+_COLDSTART = {
+    'files': """
+from birdid_classify import Classifier
+classifier = Classifier.__new__(Classifier)
+classifier.modelDir, classifier.identifier, classifier.prefix = {0!r}, {1!r}, {2!r}
+classifier.pool = None
+classifier._loadFiles(None)
+""",
+    'bundle': """
+from birdid_classify import Classifier
+classifier = Classifier.fromBundle({3!r})
+"""}
+
+_FIRSTPREDICTION = """
+import numpy
+from birdid_utils import histogramLength
+classifier.predict(1e-4 * numpy.ones((1, histogramLength(classifier.model)), 'float32'))
+"""
+
+
+def runColdStart(args):
+    from birdid_bundle import convert
+    directory = tempfile.mkdtemp()
+    try:
+        bundlePath = args.bundle or convert(args.modelDir, args.identifier,
+                                            args.prefix, join(directory, 'model.birdid'))
+        print('{0:>8} {1:>10}'.format('load', 'seconds'))
+        for mode in ('files', 'bundle'):
+            script = _COLDSTART[mode].format(args.modelDir, args.identifier,
+                                             args.prefix, bundlePath) + _FIRSTPREDICTION
+            best = None
+            for repeat in range(args.repeats):
+                began = time.time()
+                subprocess.check_call([sys.executable, '-c', script],
+                                      cwd=dirname(abspath(__file__)))
+                elapsed = time.time() - began
+                best = elapsed if best is None else min(best, elapsed)
+            print('{0:>8} {1:>10.3f}'.format(mode, best))
+    finally:
+        shutil.rmtree(directory)
+
+
+# Modules the entry points must not pull in just by being imported
+HEAVY_MODULES = ('sklearn', 'vlfeat', 'matplotlib', 'pylab', 'PIL', 'Image',
+                 'multiprocessing', 'scipy.io', 'scipy.sparse', 'scipy.spatial',
+                 'scipy.cluster', 'scipy.misc')
+
+IMPORT_CHECKED = ('birdid_utils', 'birdid_classify', 'birdid_cache',
+                  'birdid_bundle', 'birdid_registry', 'birdid_watch',
+                  'birdid_server', 'BirdID_Classifier')
+
+_IMPORTTIME = """
+import json, sys, time
+began = time.time()
+import {0}
+elapsed = time.time() - began
+heavy = sorted(name for name in sys.modules if sys.modules[name] is not None and
+               any(name == h or name.startswith(h + '.') for h in {1!r}))
+sys.stdout.write(json.dumps({{'seconds': elapsed, 'heavy': heavy}}))
+"""
+
+
+def importTime(module):
+    """ Seconds to import module in a new interpreter, and the heavy modules it loaded """
+    output = subprocess.check_output(
+        [sys.executable, '-c', _IMPORTTIME.format(module, HEAVY_MODULES)],
+        cwd=dirname(abspath(__file__)))
+    result = json.loads(output)
+    return result['seconds'], result['heavy']
+
+
+def runImports(args):
+    failures = []
+    print('{0:>18} {1:>8}  {2}'.format('module', 'seconds', 'heavy imports'))
+    for module in args.modules or IMPORT_CHECKED:
+        # the fastest run, after the first has warmed the disk cache
+        results = [importTime(module) for repeat in range(args.repeats)]
+        seconds = min(elapsed for elapsed, _ in results)
+        heavy = results[-1][1]
+        print('{0:>18} {1:>8.3f}  {2}'.format(module, seconds, ', '.join(heavy)))
+        if seconds > args.budget:
+            failures.append('{0} took {1:.3f} s'.format(module, seconds))
+        if heavy:
+            failures.append('{0} imported {1}'.format(module, ', '.join(heavy)))
+    if failures:
+        raise SystemExit('import budget exceeded: ' + '; '.join(failures))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers()
+
+    quantizer = commands.add_parser(
+        'quantizer', help='agreement and speed of kdtree and gemm against vq')
+    quantizer.add_argument('--words', type=int, default=600)
+    quantizer.add_argument('--descriptors', type=int, default=20000)
+    quantizer.add_argument('--noise', type=float, default=20.0)
+    quantizer.add_argument('--images', type=int, default=8,
+                           help='images the descriptors are split into for gemm')
+    quantizer.add_argument('--eps', type=float, nargs='+',
+                           default=[0.0, 0.5, 1.0, 2.0])
+    quantizer.add_argument('--min-agreement', type=float, default=0.999,
+                           help='fail if exact kdtree agrees less often')
+    quantizer.set_defaults(run=runQuantizer)
+
+    pyramid = commands.add_parser(
+        'pyramid', help='bincount pyramid against the numpy.histogram version')
+    pyramid.add_argument('--width', type=int, default=640)
+    pyramid.add_argument('--height', type=int, default=480)
+    pyramid.add_argument('--words', type=int, default=600)
+    pyramid.add_argument('--spatial', type=int, nargs='+', default=[2, 4])
+    pyramid.add_argument('--tolerance', type=float, default=1e-6)
+    pyramid.set_defaults(run=runPyramid)
+
+    decode = commands.add_parser(
+        'decode', help='imread + standardizeImage against loadImage')
+    decode.add_argument('images', nargs='*',
+                        help='images to load instead of synthetic JPEGs')
+    decode.add_argument('--width', type=int, default=2592)
+    decode.add_argument('--height', type=int, default=1944)
+    decode.add_argument('--count', type=int, default=10)
+    decode.set_defaults(run=runDecode)
+
+    sparse = commands.add_parser(
+        'sparse', help='memory and speed of sparse against dense histograms')
+    sparse.add_argument('--images', type=int, default=200)
+    sparse.add_argument('--descriptors', type=int, default=20000,
+                        help='descriptors per image')
+    sparse.add_argument('--words', type=int, default=600)
+    sparse.add_argument('--zipf', type=float, default=1.3,
+                        help='skew of the visual word distribution')
+    sparse.add_argument('--classes', type=int, default=9)
+    sparse.add_argument('--width', type=int, default=640)
+    sparse.add_argument('--height', type=int, default=480)
+    sparse.set_defaults(run=runSparse)
+
+    suite = commands.add_parser(
+        'suite', help='time every pipeline stage, optionally against a baseline')
+    suite.add_argument('--width', type=int, default=1024)
+    suite.add_argument('--height', type=int, default=768)
+    suite.add_argument('--count', type=int, default=20)
+    suite.add_argument('--words', type=int, default=600)
+    suite.add_argument('--classes', type=int, default=9)
+    suite.add_argument('--quantizer', choices=['vq', 'gemm', 'kdtree'], default='vq')
+    suite.add_argument('--jobs', type=int, default=1,
+                       help='worker processes for the end to end stage')
+    suite.add_argument('--repeats', type=int, default=3,
+                       help='runs per stage; the fastest counts')
+    suite.add_argument('--output', help='write the results to this JSON file')
+    suite.add_argument('--baseline', help='results JSON of an earlier run')
+    suite.add_argument('--threshold', type=float, default=0.10,
+                       help='allowed slowdown per stage, as a fraction')
+    suite.add_argument('--noise-floor', type=float, default=1e-4,
+                       help='ignore stages faster than this many seconds per image')
+    suite.set_defaults(run=runSuite)
+
+    coldstart = commands.add_parser(
+        'coldstart', help='time to first prediction from the model files '
+        'and from a bundle, each in a new process')
+    coldstart.add_argument('modelDir')
+    coldstart.add_argument('identifier')
+    coldstart.add_argument('prefix')
+    coldstart.add_argument('--bundle', help='existing bundle of the model; '
+                           'converted to a temporary file by default')
+    coldstart.add_argument('--repeats', type=int, default=3)
+    coldstart.set_defaults(run=runColdStart)
+
+    imports = commands.add_parser(
+        'imports', help='check that the entry points import quickly and '
+        'without their heavy dependencies')
+    imports.add_argument('modules', nargs='*',
+                         help='modules to check instead of the entry points')
+    imports.add_argument('--budget', type=float, default=0.3,
+                         help='seconds allowed per import')
+    imports.add_argument('--repeats', type=int, default=3)
+    imports.set_defaults(run=runImports)
+
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+""" Single-file model bundles
+
+A bundle holds everything Classifier needs from the three files
+phow_train.py writes (the pickled Configuration in PREFIX-IDENTIFIER-result,
+the pickled SVM in PREFIX-IDENTIFIER-model.py.mat and the vocabulary in
+IDENTIFIER-vocab.py.mat), without pickles or a MAT parser:
+
+    8 bytes   magic 'BIRDIDB\\0'
+    4 bytes   format version, little endian uint32
+    4 bytes   header length, little endian uint32
+    header    JSON: identifier, prefix, classes, feature configuration,
+              predictor settings and the dtype, shape and offset of each
+              array
+    padding   to a multiple of 64 bytes
+    arrays    raw little endian C order data, each starting at a multiple
+              of 64 bytes; offsets are relative to the end of the padding
+
+readBundle maps the file once and returns the arrays as read-only views of
+the mapping, so loading costs a JSON parse and no copies. Only linear
+SVMs are bundled: their weights are stored already split into the blocks
+Chi2LinearPredictor uses.
+
+    python birdid_bundle.py convert MODELDIR IDENTIFIER PREFIX [OUTPUT]
+    python birdid_bundle.py info BUNDLE
+"""
+
+import argparse
+import json
+import mmap
+import struct
+import sys
+import numpy
+from os import rename
+from os.path import join
+from birdid_utils import Configuration, PHOWOptions, ensure_type_array
+
+MAGIC = b'BIRDIDB\x00'
+VERSION = 1
+ALIGNMENT = 64
+EXTENSION = '.birdid'
+
+_PREAMBLE = struct.Struct('<8sII')
+
+
+def bundleName(identifier, prefix):
+    """ File name of the bundle of a model, next to its other files """
+    return prefix + '-' + identifier + EXTENSION
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def writeBundle(path, header, arrays):
+    """ Write header (a JSON-able dict) and arrays (name, array pairs) to path
+
+    The array layout is added to header under 'arrays'. The file is
+    written next to path and renamed into place.
+    """
+    header = dict(header)
+    layout = {}
+    data = []
+    offset = 0
+    for name, array in arrays:
+        array = numpy.asarray(array)
+        array = numpy.ascontiguousarray(array, array.dtype.newbyteorder('<'))
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape),
+                        'offset': offset}
+        data.append((offset, array))
+        offset = _aligned(offset + array.nbytes)
+    header['arrays'] = layout
+    text = json.dumps(header, sort_keys=True).encode('utf-8')
+    dataStart = _aligned(_PREAMBLE.size + len(text))
+
+    temp = path + '.tmp'
+    with open(temp, 'wb') as fp:
+        fp.write(_PREAMBLE.pack(MAGIC, VERSION, len(text)))
+        fp.write(text)
+        for arrayOffset, array in data:
+            fp.write(b'\0' * (dataStart + arrayOffset - fp.tell()))
+            fp.write(array.tostring())
+    rename(temp, path)
+
+
+def readBundle(path):
+    """ (header, arrays) of a bundle, the arrays mapped read-only from the file """
+    with open(path, 'rb') as fp:
+        magic, version, headerLength = _PREAMBLE.unpack(fp.read(_PREAMBLE.size))
+        if magic != MAGIC:
+            raise ValueError(path + ' is not a model bundle')
+        if version > VERSION:
+            raise ValueError('{0} is bundle format version {1}; this version '
+                             'reads up to {2}'.format(path, version, VERSION))
+        header = json.loads(fp.read(headerLength).decode('utf-8'))
+        # The mapping stays valid after the file is closed
+        mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    dataStart = _aligned(_PREAMBLE.size + headerLength)
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype = numpy.dtype(str(spec['dtype']))
+        shape = tuple(spec['shape'])
+        count = int(numpy.prod(shape))
+        arrays[name] = numpy.frombuffer(mapped, dtype, count,
+                                        dataStart + spec['offset']).reshape(shape)
+    return header, arrays
+
+
+def _plain(value):
+    # JSON-able copy of configuration values, which may be numpy types
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return value
+
+
+def describeConfiguration(conf):
+    """ The settings of conf that feature extraction and placement use """
+    phowOpts = conf.phowOpts
+    return {'phowOpts': {'Verbose': _plain(phowOpts.Verbose),
+                         'Sizes': _plain(ensure_type_array(phowOpts.Sizes)),
+                         'Step': _plain(phowOpts.Step),
+                         'MaxDescriptors': _plain(getattr(phowOpts, 'MaxDescriptors', None))},
+            'numWords': _plain(conf.numWords),
+            'numSpatialX': _plain(ensure_type_array(conf.numSpatialX)),
+            'numSpatialY': _plain(ensure_type_array(conf.numSpatialY)),
+            'quantizer': getattr(conf, 'quantizer', 'vq'),
+            'kdtreeEps': getattr(conf, 'kdtreeEps', 0.0),
+            'extensions': list(conf.extensions)}
+
+
+def configurationFromHeader(header):
+    """ A Configuration with the settings describeConfiguration stored """
+    config = header['config']
+    # Configuration.__init__ creates its training data directory
+    conf = Configuration.__new__(Configuration)
+    opts = config['phowOpts']
+    conf.phowOpts = PHOWOptions(Verbose=opts['Verbose'],
+                                Sizes=ensure_type_array(opts['Sizes']),
+                                Step=opts['Step'],
+                                MaxDescriptors=opts['MaxDescriptors'])
+    conf.numWords = config['numWords']
+    conf.numSpatialX = ensure_type_array(config['numSpatialX'])
+    conf.numSpatialY = ensure_type_array(config['numSpatialY'])
+    conf.quantizer = str(config['quantizer'])
+    conf.kdtreeEps = config['kdtreeEps']
+    conf.extensions = [str(e) for e in config['extensions']]
+    conf.identifier = header['identifier']
+    conf.prefix = header['prefix']
+    conf.classes = header['classes']
+    conf.numCore = 1
+    return conf
+
+
+def convert(modelDir, identifier, prefix, output=None, sampleSteps=2):
+    """ Bundle the result, model and vocab files of a model; returns its path
+
+    output defaults to bundleName(identifier, prefix) in modelDir. Raises
+    ValueError for classifiers that are not linear in the chi2 feature map.
+    """
+    from cPickle import load
+    from scipy.io import loadmat
+    with open(join(modelDir, prefix + '-' + identifier + '-result'), 'rb') as fp:
+        conf = load(fp)
+    with open(join(modelDir, prefix + '-' + identifier + '-model.py.mat'), 'rb') as fp:
+        clf = load(fp)
+    vocab = loadmat(join(modelDir, identifier + '-vocab.py.mat'))['vocab']
+
+    # What Chi2LinearPredictor.supports accepts
+    if not hasattr(clf, 'coef_') or hasattr(clf, 'support_'):
+        raise ValueError('only linear classifiers can be bundled, not ' +
+                         type(clf).__name__)
+    coef = numpy.atleast_2d(clf.coef_)
+    numBlocks = 2 * sampleSteps - 1
+    numBins = coef.shape[1] // numBlocks
+    labels = numpy.asarray(clf.classes_)
+    if labels.dtype.kind not in 'iub':
+        raise ValueError('class labels of the SVM must be class indices')
+    # weights[k] is block k of coef_, transposed, as Chi2LinearPredictor
+    # multiplies it
+    weights = coef.reshape(coef.shape[0], numBlocks, numBins).transpose(1, 2, 0)
+
+    header = {'identifier': identifier, 'prefix': prefix,
+              'classes': [str(c) for c in conf.classes],
+              'config': describeConfiguration(conf),
+              'predictor': {'type': 'chi2-linear', 'sampleSteps': sampleSteps}}
+    output = output or join(modelDir, bundleName(identifier, prefix))
+    writeBundle(output, header, [('vocab', vocab),
+                                 ('weights', weights.astype('float64')),
+                                 ('intercept', numpy.ravel(clf.intercept_).astype('float64')),
+                                 ('labels', labels.astype('int64'))])
+    return output
+
+
+def runConvert(args):
+    output = convert(args.modelDir, args.identifier, args.prefix, args.output)
+    sys.stdout.write(output + '\n')
+    return 0
+
+
+def runInfo(args):
+    header, arrays = readBundle(args.bundle)
+    sys.stdout.write(json.dumps(header, indent=2, sort_keys=True) + '\n')
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers()
+
+    convertParser = commands.add_parser(
+        'convert', help='bundle the files of a trained model')
+    convertParser.add_argument('modelDir')
+    convertParser.add_argument('identifier')
+    convertParser.add_argument('prefix')
+    convertParser.add_argument('output', nargs='?',
+                               help='bundle path, MODELDIR/PREFIX-IDENTIFIER.birdid by default')
+    convertParser.set_defaults(run=runConvert)
+
+    infoParser = commands.add_parser('info', help='print the header of a bundle')
+    infoParser.add_argument('bundle')
+    infoParser.set_defaults(run=runInfo)
+
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
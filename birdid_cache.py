@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+""" Persistent per-image histogram cache
+
+Histograms are stored as .npy files under a cache directory, keyed by the
+image (its content hash, or its path, size and mtime) and by a fingerprint
+of everything else that determines the histogram: the PHOW options, the
+spatial pyramid, the quantizer and the vocabulary. Changing any of these
+simply stops old entries from matching; they age out through the LRU.
+
+Optionally the raw PHOW frames and descriptors are kept as well, keyed on
+the PHOW options only, so a new vocabulary can reuse them.
+"""
+
+import hashlib
+from collections import OrderedDict
+from os import listdir, makedirs, remove, rename, stat, getpid, utime
+from os.path import abspath, dirname, exists, getsize, getmtime, isdir, join
+import numpy
+import birdid_utils
+from birdid_utils import isSparse
+
+
+def _describe(value):
+    # Stable text for fingerprinting option objects and arrays
+    if isinstance(value, numpy.ndarray):
+        return repr(value.tolist())
+    if hasattr(value, '__dict__'):
+        return repr([(k, _describe(v)) for k, v in sorted(vars(value).items())])
+    return repr(value)
+
+
+def featureFingerprint(conf):
+    """ Fingerprint of the options that determine PHOW descriptors """
+    text = _describe(conf.phowOpts)
+    if birdid_utils.FASTDECODE:
+        # Draft-mode decoding changes the pixels, so it gets its own entries
+        text += ' FASTDECODE'
+    return hashlib.sha1(text).hexdigest()
+
+
+def modelFingerprint(model, conf):
+    """ Fingerprint of everything besides the image that determines its histogram """
+    digest = hashlib.sha1(featureFingerprint(conf))
+    digest.update(_describe(model.numSpatialX))
+    # gemm assigns the same words as vq, so they share cache entries
+    digest.update(_describe('vq' if model.quantizer == 'gemm' else model.quantizer))
+    if model.quantizer == 'kdtree':
+        digest.update(_describe(model.kdtreeEps))
+    vocab = numpy.ascontiguousarray(model.vocab)
+    digest.update(_describe((vocab.dtype.str, vocab.shape)))
+    digest.update(vocab.data)
+    return digest.hexdigest()
+
+
+def fileKey(imagefname, keyMode='content'):
+    """ Identity of an image file
+
+    keyMode 'content' hashes the file, so renamed or moved images still hit.
+    'stat' uses the absolute path, size and mtime, which avoids reading the
+    file but misses after a move and can be fooled by in-place edits that
+    keep both.
+    """
+    if keyMode == 'content':
+        digest = hashlib.sha1()
+        with open(imagefname, 'rb') as fp:
+            for block in iter(lambda: fp.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    elif keyMode == 'stat':
+        info = stat(imagefname)
+        return hashlib.sha1(repr((abspath(imagefname), info.st_size,
+                                  info.st_mtime))).hexdigest()
+    else:
+        raise ValueError('cache key mode {0} not known or understood'.format(keyMode))
+
+
+class HistogramCache(object):
+    """ Size-capped, least recently used on-disk cache of image histograms
+
+    hits and misses count histogram lookups made through this instance.
+    """
+
+    def __init__(self, cacheDir, model, conf, maxBytes=1 << 30,
+                 keyMode='content', descriptors=False):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.keyMode = keyMode
+        self.descriptors = descriptors
+        self.histFingerprint = modelFingerprint(model, conf)
+        self.featureFingerprint = featureFingerprint(conf)
+        self.hits = 0
+        self.misses = 0
+        self._pendingKeys = {}
+        self._scan()
+
+    def _scan(self):
+        # Oldest first, so eviction pops from the front
+        entries = []
+        if isdir(self.cacheDir):
+            for shard in listdir(self.cacheDir):
+                shardDir = join(self.cacheDir, shard)
+                if not isdir(shardDir):
+                    continue
+                for fname in listdir(shardDir):
+                    if fname.endswith('.npy') or fname.endswith('.npz'):
+                        path = join(shardDir, fname)
+                        entries.append((getmtime(path), path, getsize(path)))
+        entries.sort()
+        self._entries = OrderedDict((path, size) for _, path, size in entries)
+        self.size = sum(self._entries.values())
+
+    def _imageKey(self, imagefname):
+        # A histogram miss is followed by a store for the same image, and
+        # computeHistogramsMulti looks up every image before storing any,
+        # so keys are kept from the lookup until the histogram is stored
+        key = self._pendingKeys.get(imagefname)
+        if key is None:
+            key = self._pendingKeys[imagefname] = fileKey(imagefname, self.keyMode)
+        return key
+
+    def _path(self, imagefname, fingerprint, extension):
+        name = hashlib.sha1(self._imageKey(imagefname) + fingerprint).hexdigest()
+        return join(self.cacheDir, name[:2], name + extension)
+
+    def _load(self, path, loader):
+        if not exists(path):
+            return None
+        try:
+            value = loader(path)
+        except (IOError, ValueError):
+            # Truncated by a crash or an eviction in another process
+            return None
+        utime(path, None)
+        self._track(path)
+        return value
+
+    def _store(self, path, saver):
+        shardDir = dirname(path)
+        if not isdir(shardDir):
+            try:
+                makedirs(shardDir)
+            except OSError:
+                pass  # created concurrently
+        # Write then rename so readers never see a partial entry
+        temp = path + '.' + str(getpid()) + '.tmp'
+        with open(temp, 'wb') as fp:
+            saver(fp)
+        rename(temp, path)
+        self._track(path)
+        self._evict()
+
+    def _track(self, path):
+        # Move path to the most recently used end; it may also be new to us
+        # if another process wrote it after _scan
+        self.size -= self._entries.pop(path, 0)
+        self._entries[path] = getsize(path)
+        self.size += self._entries[path]
+
+    def _evict(self):
+        while self.size > self.maxBytes and self._entries:
+            path, size = self._entries.popitem(last=False)
+            self.size -= size
+            try:
+                remove(path)
+            except OSError:
+                pass
+
+    def getHistogram(self, imagefname):
+        path = self._path(imagefname, self.histFingerprint, '.npy')
+        hist = self._load(path, numpy.load)
+        if hist is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            del self._pendingKeys[imagefname]
+        return hist
+
+    def putHistogram(self, imagefname, hist):
+        # Sparse rows are stored densely; getHistogram always returns a
+        # dense vector
+        if isSparse(hist):
+            hist = hist.toarray().ravel()
+        path = self._path(imagefname, self.histFingerprint, '.npy')
+        self._pendingKeys.pop(imagefname, None)
+        self._store(path, lambda fp: numpy.save(fp, hist))
+
+    def getFeatures(self, imagefname):
+        """ (frames, descrs, width, height) as returned by getImageFeatures """
+        if not self.descriptors:
+            return None
+        path = self._path(imagefname, self.featureFingerprint, '.npz')
+
+        def loader(path):
+            with numpy.load(path) as data:
+                return (data['frames'], data['descrs'],
+                        int(data['width']), int(data['height']))
+        return self._load(path, loader)
+
+    def putFeatures(self, imagefname, features):
+        if not self.descriptors:
+            return
+        frames, descrs, width, height = features
+        path = self._path(imagefname, self.featureFingerprint, '.npz')
+        self._store(path, lambda fp: numpy.savez(fp, frames=frames, descrs=descrs,
+                                                 width=width, height=height))
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        rate = 100.0 * self.hits / lookups if lookups else 0.0
+        return 'Histogram cache: {0} hits, {1} misses ({2:.0f}% hit rate), ' \
+            '{3:.1f} MB in {4} entries'.format(self.hits, self.misses, rate,
+                                              self.size / float(1 << 20),
+                                              len(self._entries))
+
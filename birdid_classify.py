@@ -0,0 +1,740 @@
+#!/usr/bin/env python
+""" Classify bird images without the GUI
+
+Library functions behind the Classify button of BirdID_Classifier, plus a
+command line entry point for headless use:
+
+    python birdid_classify.py MODELDIR IDENTIFIER PREFIX INPUTDIR OUTPUTDIR
+
+Status messages go to stderr. stdout receives one JSON object with timing
+information when the run finishes (preceded, with --dry-run, by one
+"image<TAB>class" line per image), so it can be parsed by scripts. Nothing
+in here imports Tk.
+"""
+
+import argparse
+import hashlib
+import json
+import sys
+import time
+import numpy
+from cPickle import load
+from datetime import datetime
+from os import fsync, mkdir, stat
+from os.path import abspath, dirname, exists, getmtime, join
+from birdid_utils import Model, get_imgfiles, computeHistograms, computeHistogramsMulti, \
+    openHistogramPool, openHistogramStore, isSparse, nativeStr
+from birdid_cache import HistogramCache
+from birdid_bundle import bundleName, readBundle, configurationFromHeader, \
+    describeConfiguration
+from birdid_placement import ImagePlacer, PLACEMENT_MODES, COLLISION_POLICIES
+import birdid_stats
+
+
+def printStatus(message):
+    sys.stderr.write(message + '\n')
+
+
+class Cancelled(Exception):
+    """ Raised by classifyImages when its cancel event is set """
+    pass
+
+
+class Chi2LinearPredictor(object):
+    """ AdditiveChi2Sampler followed by a linear classifier, fused
+
+    The explicit chi2 feature map of a histogram row x is
+    [sqrt(L x), f_j(x) cos(j L log x), f_j(x) sin(j L log x), ...] for
+    j = 1 .. sampleSteps - 1, each block as wide as x, with L the sample
+    interval and f_j(x) = sqrt(2 L x / cosh(pi j L)). A linear classifier
+    dots that with coef_, so the weights are split into the matching
+    blocks once, and each block of rows is mapped and scored without
+    building the (2 * sampleSteps - 1) times wider matrix.
+    """
+
+    def __init__(self, clf, sampleSteps=2, sampleInterval=None, blockSize=256):
+        coef = numpy.atleast_2d(clf.coef_)
+        numBins = coef.shape[1] // (2 * sampleSteps - 1)
+        weights = [numpy.ascontiguousarray(coef[:, k * numBins:(k + 1) * numBins].T)
+                   for k in range(2 * sampleSteps - 1)]
+        self._setup(weights, clf.intercept_, clf.classes_, sampleSteps,
+                    sampleInterval, blockSize)
+
+    @classmethod
+    def fromWeights(cls, weights, intercept, classes, sampleSteps=2,
+                    sampleInterval=None, blockSize=256):
+        """ Predictor from coef_ already split into the transposed blocks
+
+        weights[k] is used as is, so arrays memory-mapped from a model
+        bundle are not copied.
+        """
+        predictor = cls.__new__(cls)
+        predictor._setup(list(weights), intercept, classes, sampleSteps,
+                         sampleInterval, blockSize)
+        return predictor
+
+    def _setup(self, weights, intercept, classes, sampleSteps, sampleInterval,
+               blockSize):
+        if sampleInterval is None:
+            # AdditiveChi2Sampler's defaults
+            sampleInterval = {1: 0.8, 2: 0.5, 3: 0.4}[sampleSteps]
+        self.sampleSteps = sampleSteps
+        self.sampleInterval = sampleInterval
+        self.blockSize = blockSize
+        self.classes = classes
+        self.weights = weights
+        self.intercept = numpy.ravel(intercept)
+
+    @staticmethod
+    def supports(clf):
+        """ Whether clf predicts by the arg max (or sign) of X coef_.T + intercept_ """
+        # SVC(kernel='linear') has coef_ too, but votes one-vs-one
+        return (hasattr(clf, 'coef_') and not hasattr(clf, 'support_') and
+                numpy.atleast_2d(clf.coef_).shape[0] in (1, len(clf.classes_)))
+
+    def _mapped(self, x):
+        # The blocks of the feature map of the non-zero values x, in the
+        # order of the weight blocks
+        interval = self.sampleInterval
+        blocks = [numpy.sqrt(x * interval)]
+        logStep = interval * numpy.log(x)
+        step = 2 * x * interval
+        for j in range(1, self.sampleSteps):
+            factor = numpy.sqrt(step / numpy.cosh(numpy.pi * j * interval))
+            blocks.append(factor * numpy.cos(j * logStep))
+            blocks.append(factor * numpy.sin(j * logStep))
+        return blocks
+
+    def decisionFunction(self, hists):
+        """ Per-class scores, shaped like clf.decision_function's output """
+        scores = numpy.empty((hists.shape[0], len(self.intercept)))
+        for start in range(0, hists.shape[0], self.blockSize):
+            block = hists[start:start + self.blockSize]
+            if isSparse(block):
+                from scipy.sparse import csr_matrix
+                block = block.tocsr()
+                total = 0
+                for mapped, weights in zip(self._mapped(block.data), self.weights):
+                    total = total + csr_matrix(
+                        (mapped, block.indices, block.indptr),
+                        shape=block.shape).dot(weights)
+            else:
+                block = numpy.asarray(block)
+                nonZero = block != 0
+                total = 0
+                for mapped, weights in zip(self._mapped(block[nonZero]), self.weights):
+                    full = numpy.zeros_like(block)
+                    full[nonZero] = mapped
+                    total = total + full.dot(weights)
+            scores[start:start + block.shape[0]] = total + self.intercept
+        if scores.shape[1] == 1:
+            return scores[:, 0]
+        return scores
+
+    def predict(self, hists):
+        """ Predicted labels and the decision scores they were chosen from """
+        scores = self.decisionFunction(hists)
+        if scores.ndim == 1:
+            indices = (scores > 0).astype('int')
+        else:
+            indices = scores.argmax(axis=1)
+        return self.classes[indices], scores
+
+
+class Classifier(object):
+    """ A trained model: training configuration, vocabulary and SVM
+
+    The files are looked up in modelDir the way phow_train.py names them:
+    PREFIX-IDENTIFIER-result, PREFIX-IDENTIFIER-model.py.mat and
+    IDENTIFIER-vocab.py.mat. If modelDir also has a bundle of them
+    (PREFIX-IDENTIFIER.birdid, see birdid_bundle) that is at least as new
+    as each of them, the bundle is loaded instead; clf is then None.
+    classifierPath is the file the SVM was read from.
+    """
+
+    def __init__(self, modelDir, identifier, prefix, status=None):
+        self.modelDir = modelDir
+        self.identifier = identifier
+        self.prefix = prefix
+        self.pool = None
+
+        bundlePath = join(modelDir, bundleName(identifier, prefix))
+        sources = [join(modelDir, prefix + '-' + identifier + '-result'),
+                   join(modelDir, prefix + '-' + identifier + '-model.py.mat'),
+                   join(modelDir, identifier + '-vocab.py.mat')]
+        if exists(bundlePath) and all(getmtime(bundlePath) >= getmtime(path)
+                                      for path in sources if exists(path)):
+            self._loadBundle(bundlePath, status)
+        else:
+            self._loadFiles(status)
+
+    @classmethod
+    def fromBundle(cls, bundlePath, status=None):
+        """ Classifier for a bundle file anywhere """
+        classifier = cls.__new__(cls)
+        classifier.modelDir = dirname(bundlePath)
+        classifier.pool = None
+        classifier._loadBundle(bundlePath, status)
+        return classifier
+
+    def _loadBundle(self, bundlePath, status):
+        if status:
+            status(str(datetime.now()) + ' Loading model bundle ' + bundlePath)
+        header, arrays = readBundle(bundlePath)
+        self.identifier = header['identifier']
+        self.prefix = header['prefix']
+        self.conf = configurationFromHeader(header)
+        self.classes = self.conf.classes
+        if status:
+            status(str(datetime.now()) + " Found classes " + str(self.classes))
+        self.model = Model([], self.conf, arrays['vocab'])
+        self.clf = None
+        self.classifierPath = bundlePath
+        self.predictor = Chi2LinearPredictor.fromWeights(
+            arrays['weights'], arrays['intercept'], arrays['labels'],
+            header['predictor']['sampleSteps'])
+
+    def _loadFiles(self, status):
+        modelDir, identifier, prefix = self.modelDir, self.identifier, self.prefix
+
+        # Load configuration from result of training so we're working with
+        # the same parameters
+        resultPath = join(modelDir, prefix + '-' + identifier + '-result')
+        with open(resultPath, 'rb') as fp:
+            self.conf = load(fp)
+        self.classes = self.conf.classes
+        if status:
+            status(str(datetime.now()) + " Found classes " + str(self.classes))
+
+        # The Model class is just a subset of the Configuration class wth
+        # the set of categories added in. The categories aren't needed for
+        # this preprocessing, since they only have an impact on the final
+        # classification. We do need the class names to decide how to name
+        # the destination folders, however.
+        self.model = Model([], self.conf)
+
+        # Load existing model for classification
+        modelFileName = prefix + '-' + identifier + '-model.py.mat'
+        if status:
+            status(str(datetime.now()) + ' Loading model from ' + modelFileName)
+        self.classifierPath = join(modelDir, modelFileName)
+        with open(self.classifierPath, 'rb') as fp:
+            # SVM classifier trained on similar data
+            self.clf = load(fp)
+
+        # Use vocabulary extracted from training images
+        from scipy.io import loadmat
+        self.model.vocab = loadmat(join(modelDir, identifier + '-vocab.py.mat'))['vocab']
+
+        # Feature map and SVM fused for linear models, built once here
+        self.predictor = None
+        if Chi2LinearPredictor.supports(self.clf):
+            self.predictor = Chi2LinearPredictor(self.clf)
+
+    def startPool(self, jobs):
+        """ Keep jobs worker processes running for all later histograms calls """
+        self.conf.numCore = jobs
+        self.pool = openHistogramPool(self.model, self.conf)
+
+    def stopPool(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def histograms(self, imgs, jobs=1, cache=None, progress=None, out=None):
+        """ Spatial histograms of the image files imgs, one row per image
+
+        out, if given, receives the rows (see openHistogramStore).
+        """
+        if self.pool is not None:
+            return computeHistogramsMulti(imgs, self.model, self.conf, cache,
+                                          progress, pool=self.pool, out=out)
+        if jobs > 1:
+            # numCore in the pickled configuration is the training machine's
+            self.conf.numCore = jobs
+            return computeHistogramsMulti(imgs, self.model, self.conf, cache,
+                                          progress, out=out)
+        return computeHistograms(imgs, self.model, self.conf, cache, progress,
+                                 out=out)
+
+    def predict(self, hists, chunkSize=0):
+        """ Index into self.classes of the predicted class of each histogram
+
+        hists may be dense or scipy.sparse CSR.
+        """
+        return self.predictWithScores(hists, chunkSize)[0]
+
+    @birdid_stats.timed('predict')
+    def predictWithScores(self, hists, chunkSize=0):
+        """ Predicted classes and per-class decision scores of histograms
+
+        Linear SVMs go through the fused Chi2LinearPredictor, which maps
+        and scores the histograms block by block. Other classifiers get
+        the explicit AdditiveChi2Sampler map, chunkSize rows at a time
+        (all at once if 0), and scores from their decision_function.
+        """
+        if self.predictor is not None:
+            return self.predictor.predict(hists)
+        # sklearn is only needed here; the SVM pickle imports its own parts
+        from sklearn.kernel_approximation import AdditiveChi2Sampler
+        chunkSize = chunkSize or max(hists.shape[0], 1)
+        predicted = []
+        scores = []
+        for start in range(0, hists.shape[0], chunkSize):
+            histst = AdditiveChi2Sampler().fit_transform(hists[start:start + chunkSize])
+            predicted.append(self.clf.predict(histst))
+            scores.append(self.clf.decision_function(histst))
+        if not predicted:
+            return numpy.array([], 'int'), numpy.zeros((0, len(self.classes)))
+        return numpy.concatenate(predicted), numpy.concatenate(scores)
+
+    def openCache(self, cacheDir, maxBytes=2 << 30):
+        return HistogramCache(cacheDir, self.model, self.conf, maxBytes=maxBytes)
+
+
+def classifierFingerprint(classifier):
+    """ Fingerprint of the vocabulary, features and SVM of a Classifier
+
+    Taken from what was loaded rather than from the files it came from, so
+    a model loaded from its bundle has the same fingerprint as when it is
+    loaded from the result, model and vocab files.
+    """
+    digest = hashlib.sha1(json.dumps(
+        {'config': describeConfiguration(classifier.conf),
+         'classes': [str(c) for c in classifier.classes]}, sort_keys=True))
+    vocab = numpy.ascontiguousarray(classifier.model.vocab)
+    digest.update(repr((vocab.dtype.str, vocab.shape)))
+    digest.update(vocab.data)
+    predictor = classifier.predictor
+    if predictor is None:
+        # Not linear, so never bundled: the SVM file is the model
+        with open(classifier.classifierPath, 'rb') as fp:
+            for block in iter(lambda: fp.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    # In the types birdid_bundle stores them in
+    digest.update(repr((predictor.sampleSteps, predictor.sampleInterval)))
+    arrays = [numpy.ascontiguousarray(weights, '<f8') for weights in predictor.weights]
+    arrays.append(numpy.ascontiguousarray(predictor.intercept, '<f8'))
+    arrays.append(numpy.ascontiguousarray(predictor.classes, '<i8'))
+    for array in arrays:
+        digest.update(repr(array.shape))
+        digest.update(array.data)
+    return digest.hexdigest()
+
+
+class Journal(object):
+    """ Checkpoints of a classifyImages run, one JSON line per finished batch
+
+    Each record lists the images of the batch with their size, mtime,
+    predicted class and histogram row, how long the batch took, the model
+    fingerprint and destination it was classified for and, if the
+    histograms were kept, the file and the listing of images (see
+    listingFingerprint) the rows are for. A run given the journal of an
+    earlier run with the same model and destination skips the images it
+    records, unless they have changed since.
+    """
+
+    def __init__(self, path, fingerprint, destFolder):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.destination = None if destFolder is None else abspath(destFolder)
+        self.done = {}
+        self.batches = 0
+        if exists(path):
+            with open(path) as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # cut short by a crash
+                    destination = entry.get('destination')
+                    if destination is not None:
+                        destination = nativeStr(destination)
+                    if entry.get('fingerprint') != fingerprint or \
+                            destination != self.destination:
+                        continue  # another model or destination
+                    self._add(entry)
+
+    def _add(self, entry):
+        # Paths come back from JSON as unicode; they are compared with the
+        # listing's str paths
+        histograms = entry.get('histograms')
+        for image in entry['images']:
+            imagefname, size, mtime, classIndex = image[:4]
+            row = None
+            if histograms is not None and len(image) > 4:
+                row = (nativeStr(histograms['path']), histograms['listing'], image[4])
+            self.done[nativeStr(imagefname)] = (size, mtime, classIndex, row)
+        self.batches += 1
+
+    def finished(self, imagefname, row=None):
+        """ Predicted class of imagefname if this journal has it, else None
+
+        With row, a (histogram file, listing fingerprint, row index)
+        triple, only if the image's histogram was written to that row of
+        that file for that listing.
+        """
+        entry = self.done.get(abspath(imagefname))
+        if entry is None or (row is not None and entry[3] != tuple(row)):
+            return None
+        try:
+            info = stat(imagefname)
+        except OSError:
+            return None
+        if entry[0] != info.st_size or entry[1] != info.st_mtime:
+            return None
+        return entry[2]
+
+    @staticmethod
+    def describe(imagefname):
+        """ What record needs of an image, taken before it is placed (or moved) """
+        info = stat(imagefname)
+        return [abspath(imagefname), info.st_size, info.st_mtime]
+
+    def record(self, described, predicted, rows, seconds, stages, histograms=None):
+        """ Commit a finished batch; it is on disk when this returns
+
+        described holds describe() of each image of the batch and rows
+        their rows in the histogram file; histograms is None or a dict
+        with the path of that file and the listing fingerprint.
+        """
+        images = [image + [int(classIndex), row]
+                  for image, classIndex, row in zip(described, predicted, rows)]
+        entry = {'fingerprint': self.fingerprint, 'destination': self.destination,
+                 'images': images, 'histograms': histograms,
+                 'seconds': seconds, 'stages': stages, 'time': time.time()}
+        with open(self.path, 'a') as fp:
+            fp.write(json.dumps(entry, sort_keys=True) + '\n')
+            fp.flush()
+            fsync(fp.fileno())
+        self._add(entry)
+
+
+def listingFingerprint(imgs):
+    """ Fingerprint of a list of image files, in order """
+    return hashlib.sha1('\n'.join(abspath(imagefname) for imagefname in imgs)).hexdigest()
+
+
+# Create a directory if it doesn't already exist
+def create_dir(dirName):
+    try:
+        mkdir(dirName)
+    except OSError:
+        pass
+
+    return
+
+
+def createClassFolders(destFolder, classes, status=printStatus):
+    """ Create destFolder/CLASS for every class and return their paths """
+    # Check that top level destination folder exists and create if not.
+    status(str(datetime.now()) + " Creating destination folders in")
+    status("    " + destFolder)
+    if not exists(destFolder):
+        create_dir(destFolder)
+
+    pathToClass = []
+    for className in classes:
+        pathToClass.append(join(destFolder, str(className)))
+        status("    " + pathToClass[-1])
+        if not exists(pathToClass[-1]):
+            create_dir(pathToClass[-1])
+    return pathToClass
+
+
+def classifyImages(classifier, imgs, destFolder, jobs=1, batchSize=0,
+                   dryRun=False, cache=None, status=printStatus,
+                   progress=None, cancel=None, histogramPath=None,
+                   chunkSize=0, placement='copy', placementWorkers=4,
+                   collision='overwrite', journal=None):
+    """ Classify the image files imgs and copy them into per-class folders
+
+    Images are processed batchSize at a time (all at once if 0), so with a
+    batch size only one batch of histograms is held in memory and copies
+    start before the whole folder is classified. Each batch is handed to an
+    ImagePlacer (see birdid_placement for the placement modes and collision
+    policies) whose placementWorkers threads copy it while the next batch
+    is classified. With dryRun nothing is created or copied.
+
+    progress, if given, is called as progress(done, total, rate, eta) after
+    each image's histogram, with rate in images per second and eta in
+    seconds (None until known). cancel is a threading.Event; once it is set
+    Cancelled is raised before the next image is started; images already
+    being placed are finished, the rest are dropped.
+
+    With histogramPath, the histograms of all images are written to a
+    memory-mapped float32 file there (row i for imgs[i]) instead of being
+    held in memory, and the feature map and SVM run chunkSize rows at a
+    time, so peak memory depends on chunkSize rather than on len(imgs).
+
+    With a Journal, each batch is committed to it once its images are
+    placed (before the next batch is placed, so placement still overlaps
+    classification), and images it already records are skipped and get
+    their recorded class. With histogramPath, that is only for images the
+    journal records in the same row of the same file for the same imgs;
+    the others are classified again so that their rows are written. A run
+    that stops between placing a batch and committing it places that batch
+    again when resumed; with collision 'rename' and a journal that has
+    committed batches, images already in their class folder with the same
+    contents are skipped then rather than placed under a new name.
+
+    Returns the predicted class index of every image and a dict with the
+    seconds spent in each stage. place_wait is only the time spent waiting
+    for placement to finish after the last batch and, with a journal,
+    before each checkpoint; place_bytes and place_busy give the bytes
+    placed and the thread-seconds it took.
+    """
+    timings = {'histograms': 0.0, 'featuremap_predict': 0.0, 'place_wait': 0.0}
+    predicted = [None] * len(imgs)
+    todo = list(range(len(imgs)))
+    histograms = None
+    if journal is not None and histogramPath:
+        histograms = {'path': abspath(histogramPath),
+                      'listing': listingFingerprint(imgs)}
+    if journal is not None and (not histogramPath or exists(histogramPath)):
+        todo = []
+        for ii, imagefname in enumerate(imgs):
+            row = None
+            if histograms is not None:
+                row = (histograms['path'], histograms['listing'], ii)
+            classIndex = journal.finished(imagefname, row)
+            if classIndex is None:
+                todo.append(ii)
+            else:
+                predicted[ii] = classIndex
+        if len(todo) < len(imgs):
+            status(str(datetime.now()) + " Resuming: {0} of {1} images were "
+                   "classified by an earlier run".format(len(imgs) - len(todo), len(imgs)))
+    resumed = len(imgs) - len(todo)
+    placer = None
+    if not dryRun:
+        pathToClass = createClassFolders(destFolder, classifier.classes, status)
+        placer = ImagePlacer(pathToClass, placement, placementWorkers, collision)
+    # Only a resumed run can find its images placed already; comparing
+    # contents otherwise would just read every image once more
+    checkPlaced = journal is not None and collision == 'rename' and \
+        journal.batches > 0
+    batchSize = batchSize or max(len(todo), 1)
+    store = None
+    if histogramPath and classifier.model.sparseHistograms:
+        raise ValueError('a histogram store holds dense histograms only')
+    if histogramPath and imgs:
+        # Keep the rows of resumed images, written for this same imgs
+        mode = 'r+' if resumed else 'w+'
+        store = openHistogramStore(histogramPath, len(imgs), classifier.model, mode)
+    began = time.time()
+    # The batch that is being placed; it is journaled once placed
+    unrecorded = None
+
+    def checkCancel():
+        if cancel is not None and cancel.is_set():
+            raise Cancelled()
+
+    try:
+        for start in range(0, len(todo), batchSize):
+            indices = todo[start:start + batchSize]
+            batch = [imgs[ii] for ii in indices]
+            batchBegan = time.time()
+            if len(todo) > batchSize:
+                status(str(datetime.now()) + " Batch of images {0}-{1} of {2}".format(
+                    start + 1, start + len(batch), len(todo)))
+            described = None
+            if journal is not None:
+                described = [journal.describe(imagefname) for imagefname in batch]
+
+            def imageDone(doneInBatch):
+                if progress is not None:
+                    done = resumed + start + doneInBatch
+                    elapsed = time.time() - began
+                    rate = (done - resumed) / elapsed if elapsed > 0 else 0.0
+                    eta = (len(imgs) - done) / rate if rate > 0 else None
+                    progress(done, len(imgs), rate, eta)
+                checkCancel()
+
+            # Compute spatial histograms from test images
+            checkCancel()
+            status(str(datetime.now()) + " Computing spatial histograms")
+            stageBegan = time.time()
+            out = None
+            contiguous = indices[-1] - indices[0] + 1 == len(indices)
+            if store is not None and contiguous:
+                out = store[indices[0]:indices[-1] + 1]
+            hists = classifier.histograms(batch, jobs, cache, imageDone, out)
+            if store is not None and not contiguous:
+                store[indices] = hists
+            histogramSeconds = time.time() - stageBegan
+            timings['histograms'] += histogramSeconds
+            if cache is not None:
+                status(str(datetime.now()) + " " + cache.summary())
+
+            # Compute feature map of image data and classify images using
+            # trained model. predicted_classes is an array containing the
+            # index for the predicted class of each image
+            status(str(datetime.now()) + " Classifying images")
+            stageBegan = time.time()
+            predicted_classes = classifier.predict(hists, chunkSize)
+            predictSeconds = time.time() - stageBegan
+            timings['featuremap_predict'] += predictSeconds
+            for ii, classIndex in zip(indices, predicted_classes):
+                predicted[ii] = classIndex
+
+            if journal is not None:
+                if unrecorded is not None:
+                    # The previous batch has had this whole batch's time to
+                    # be placed; make sure it is before checkpointing it
+                    stageBegan = time.time()
+                    placer.wait()
+                    timings['place_wait'] += time.time() - stageBegan
+                    journal.record(*unrecorded)
+                unrecorded = (described, predicted_classes, indices,
+                              time.time() - batchBegan,
+                              {'histograms': histogramSeconds,
+                               'featuremap_predict': predictSeconds},
+                              histograms)
+                if placer is None:
+                    journal.record(*unrecorded)
+                    unrecorded = None
+
+            # Place the classified images in a new folder structure
+            # reflecting the identified classes; this runs in the background
+            # while the next batch is classified
+            if placer is not None:
+                status(str(datetime.now()) + " Placing images in destination folders")
+                for imagefname, classIndex in zip(batch, predicted_classes):
+                    if checkPlaced and placer.placedBefore(imagefname, classIndex):
+                        # Placed by the run being resumed after its last
+                        # checkpoint; placing it again would add a NAME-1
+                        placer.skip(imagefname)
+                        continue
+                    placer.submit(imagefname, classIndex)
+
+        if placer is not None:
+            stageBegan = time.time()
+            placer.wait()
+            timings['place_wait'] += time.time() - stageBegan
+            if unrecorded is not None:
+                journal.record(*unrecorded)
+            timings['place_bytes'] = placer.bytes
+            timings['place_busy'] = placer.busy
+            status(str(datetime.now()) + " " + placer.summary())
+    except Cancelled:
+        if placer is not None:
+            placer.abort()
+            status(str(datetime.now()) + " " + placer.summary())
+        raise
+    finally:
+        if placer is not None:
+            placer.close()
+
+    if store is not None:
+        store.flush()
+    return predicted, timings
+
+
+def addStatsArguments(parser):
+    parser.add_argument('--stats', metavar='PATH',
+                        help='record per-stage timings and counters to PATH')
+    parser.add_argument('--stats-format', choices=['jsonl', 'prometheus'],
+                        default='jsonl',
+                        help='append a JSON line, or write a Prometheus '
+                        'text file (for the node exporter textfile collector)')
+
+
+def writeStats(args, **extra):
+    """ Export the stats enabled for --stats, if any """
+    stats = birdid_stats.current()
+    if not args.stats or stats is None:
+        return
+    if args.stats_format == 'prometheus':
+        stats.writePrometheus(args.stats)
+    else:
+        stats.writeJSONLine(args.stats, **extra)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Classify a folder of bird images with a trained model.')
+    parser.add_argument('modelDir', help='directory containing the model files')
+    parser.add_argument('identifier', help='model identifier')
+    parser.add_argument('prefix', help='model prefix')
+    parser.add_argument('inputDir', help='directory of images to classify')
+    parser.add_argument('outputDir', help='directory for the per-class folders')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='worker processes for feature extraction')
+    parser.add_argument('--batch-size', type=int, default=0,
+                        help='images per batch, 0 for a single batch')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='print predictions instead of copying images')
+    parser.add_argument('--cache-dir',
+                        help='keep image histograms in this directory')
+    parser.add_argument('--histograms', metavar='PATH',
+                        help='write all histograms to a memory-mapped file '
+                        'instead of keeping them in memory')
+    parser.add_argument('--chunk-size', type=int, default=0,
+                        help='histograms per feature map/SVM chunk, 0 for '
+                        'a whole batch at once')
+    parser.add_argument('--sparse', action='store_true',
+                        help='use sparse histograms throughout')
+    parser.add_argument('--place', choices=PLACEMENT_MODES, default='copy',
+                        help='how images get into the class folders')
+    parser.add_argument('--place-workers', type=int, default=4,
+                        help='threads placing images')
+    parser.add_argument('--on-collision', choices=COLLISION_POLICIES,
+                        default='overwrite',
+                        help='what to do when the destination name exists')
+    parser.add_argument('--journal', metavar='PATH',
+                        help='checkpoint finished batches to PATH and skip '
+                        'the images it already records')
+    addStatsArguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.stats:
+        birdid_stats.enable()
+    began = time.time()
+    classifier = Classifier(args.modelDir, args.identifier, args.prefix,
+                            status=printStatus)
+    loadTime = time.time() - began
+    classifier.model.sparseHistograms = args.sparse
+    imgs = get_imgfiles(args.inputDir, classifier.conf.extensions)
+    cache = classifier.openCache(args.cache_dir) if args.cache_dir else None
+    journal = None
+    if args.journal:
+        journal = Journal(args.journal, classifierFingerprint(classifier),
+                          None if args.dry_run else args.outputDir)
+
+    predicted, timings = classifyImages(classifier, imgs, args.outputDir,
+                                        jobs=args.jobs,
+                                        batchSize=args.batch_size,
+                                        dryRun=args.dry_run, cache=cache,
+                                        histogramPath=args.histograms,
+                                        chunkSize=args.chunk_size,
+                                        placement=args.place,
+                                        placementWorkers=args.place_workers,
+                                        collision=args.on_collision,
+                                        journal=journal)
+    if args.dry_run:
+        for imagefname, classIndex in zip(imgs, predicted):
+            sys.stdout.write(imagefname + '\t' + str(classifier.classes[classIndex]) + '\n')
+
+    elapsed = time.time() - began
+    timings['load'] = loadTime
+    summary = {'images': len(imgs),
+               'seconds': elapsed,
+               'images_per_second': len(imgs) / elapsed if elapsed else 0.0,
+               'stages': timings,
+               'jobs': args.jobs,
+               'batch_size': args.batch_size,
+               'dry_run': args.dry_run}
+    if cache is not None:
+        summary['cache'] = {'hits': cache.hits, 'misses': cache.misses}
+    if journal is not None:
+        summary['journal'] = {'batches': journal.batches, 'images': len(journal.done)}
+    sys.stdout.write(json.dumps(summary, sort_keys=True) + '\n')
+    writeStats(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+""" Run several trained models on one folder, extracting features once
+
+All prefixes of an identifier share its vocabulary and histograms and
+differ only in the SVM, so comparing them with birdid_classify.py repeats
+PHOW extraction and quantization for every model. Here the selected models
+are grouped by everything that determines a histogram (PHOW options,
+spatial pyramid, quantizer and vocabulary, as the histogram cache
+fingerprints them); each group's histograms are computed once and every
+SVM of the group is run on them.
+
+    python birdid_compare.py MODELDIR INPUTDIR [--model PREFIX-IDENTIFIER ...]
+
+Without --model or --identifier every complete model in MODELDIR is used.
+The output is a tab separated table with one row per image and one
+column per model holding its predicted class, followed by 'agree' (1 if
+all models predicted the same class). Status messages and the agreement
+between each pair of models go to stderr.
+"""
+
+import argparse
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime
+from birdid_utils import get_imgfiles
+from birdid_cache import modelFingerprint
+from birdid_classify import Classifier, printStatus, addStatsArguments, writeStats
+from birdid_registry import ModelRegistry
+import birdid_stats
+
+
+def modelName(classifier):
+    """ PREFIX-IDENTIFIER, as the model's files are named """
+    return classifier.prefix + '-' + classifier.identifier
+
+
+def featureGroups(classifiers):
+    """ classifiers grouped by the histograms they need, in the order given """
+    groups = OrderedDict()
+    for classifier in classifiers:
+        key = modelFingerprint(classifier.model, classifier.conf)
+        groups.setdefault(key, []).append(classifier)
+    return list(groups.values())
+
+
+def compareModels(classifiers, imgs, jobs=1, batchSize=0, cacheDir=None,
+                  chunkSize=0, status=printStatus):
+    """ Predicted class index of every image for each of classifiers
+
+    The histograms of each feature group are computed by its first
+    classifier, batchSize images at a time (all at once if 0), and every
+    classifier of the group predicts from them. With cacheDir each group
+    keeps its histograms in a HistogramCache there.
+
+    Returns a list with the predictions of each classifier, in the order
+    of classifiers, and a dict with the seconds spent in each stage.
+    """
+    groups = featureGroups(classifiers)
+    status(str(datetime.now()) + ' {0} models in {1} feature groups'.format(
+        len(classifiers), len(groups)))
+    predicted = OrderedDict((id(classifier), []) for classifier in classifiers)
+    timings = {'histograms': 0.0, 'featuremap_predict': 0.0}
+    batchSize = batchSize or max(len(imgs), 1)
+    for group in groups:
+        leader = group[0]
+        status(str(datetime.now()) + ' Computing spatial histograms for ' +
+               ', '.join(modelName(classifier) for classifier in group))
+        cache = leader.openCache(cacheDir) if cacheDir else None
+        if jobs > 1:
+            # One pool for all batches of the group
+            leader.startPool(jobs)
+        try:
+            for start in range(0, len(imgs), batchSize):
+                batch = imgs[start:start + batchSize]
+                stageBegan = time.time()
+                hists = leader.histograms(batch, jobs, cache)
+                timings['histograms'] += time.time() - stageBegan
+
+                stageBegan = time.time()
+                for classifier in group:
+                    predicted[id(classifier)].extend(classifier.predict(hists, chunkSize))
+                timings['featuremap_predict'] += time.time() - stageBegan
+        finally:
+            leader.stopPool()
+        if cache is not None:
+            status(str(datetime.now()) + ' ' + cache.summary())
+    return list(predicted.values()), timings
+
+
+def predictionTable(classifiers, imgs, predicted):
+    """ Rows of the side-by-side table, header first, as lists of strings """
+    rows = [['image'] + [modelName(classifier) for classifier in classifiers] + ['agree']]
+    for ii, imagefname in enumerate(imgs):
+        classNames = [str(classifier.classes[classIndices[ii]])
+                      for classifier, classIndices in zip(classifiers, predicted)]
+        rows.append([imagefname] + classNames +
+                     ['1' if len(set(classNames)) == 1 else '0'])
+    return rows
+
+
+def pairwiseAgreement(classifiers, predicted):
+    """ Fraction of images on which each pair of models predict the same class
+
+    Returns (name, name, fraction) tuples. Classes are compared by name,
+    so models trained on different class lists can be compared too.
+    """
+    names = [[str(classifier.classes[classIndex]) for classIndex in classIndices]
+             for classifier, classIndices in zip(classifiers, predicted)]
+    result = []
+    for ii in range(len(classifiers)):
+        for jj in range(ii + 1, len(classifiers)):
+            same = sum(1 for a, b in zip(names[ii], names[jj]) if a == b)
+            result.append((modelName(classifiers[ii]), modelName(classifiers[jj]),
+                           same / float(len(names[ii])) if names[ii] else 1.0))
+    return result
+
+
+def selectedModels(modelDir, models, identifiers):
+    """ (identifier, prefix) of the models named on the command line
+
+    models are PREFIX-IDENTIFIER names; identifiers select all their
+    complete models. With neither, every complete model in modelDir.
+    """
+    registry = ModelRegistry(modelDir)
+    registry.update()
+    selected = []
+    for name in models:
+        # phow_train.py prefixes contain no '-'
+        prefix, _, identifier = name.partition('-')
+        selected.append((identifier, prefix))
+    for identifier in identifiers:
+        selected.extend((identifier, prefix) for prefix in registry.prefixes(identifier))
+    if not models and not identifiers:
+        selected = [(model['identifier'], model['prefix'])
+                    for model in registry.models() if model['complete']]
+    return selected
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('modelDir', help='directory containing the model files')
+    parser.add_argument('inputDir', help='directory of images to classify')
+    parser.add_argument('--model', action='append', default=[],
+                        metavar='PREFIX-IDENTIFIER', help='a model to run')
+    parser.add_argument('--identifier', action='append', default=[],
+                        help='run every model of this identifier')
+    parser.add_argument('--output', help='write the table here instead of stdout')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='worker processes for feature extraction')
+    parser.add_argument('--batch-size', type=int, default=0,
+                        help='images per batch, 0 for a single batch')
+    parser.add_argument('--cache-dir',
+                        help='keep image histograms in this directory')
+    parser.add_argument('--chunk-size', type=int, default=0,
+                        help='histograms per feature map/SVM chunk, 0 for '
+                        'a whole batch at once')
+    addStatsArguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.stats:
+        birdid_stats.enable()
+    selected = selectedModels(args.modelDir, args.model, args.identifier)
+    if not selected:
+        printStatus('No models found in ' + args.modelDir)
+        return 1
+    classifiers = [Classifier(args.modelDir, identifier, prefix, status=printStatus)
+                   for identifier, prefix in selected]
+    # All models of a folder were trained for the same image types
+    imgs = get_imgfiles(args.inputDir, classifiers[0].conf.extensions)
+
+    predicted, timings = compareModels(classifiers, imgs, args.jobs,
+                                       args.batch_size, args.cache_dir,
+                                       args.chunk_size)
+    fp = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for row in predictionTable(classifiers, imgs, predicted):
+            fp.write('\t'.join(row) + '\n')
+    finally:
+        if fp is not sys.stdout:
+            fp.close()
+    for first, second, fraction in pairwiseAgreement(classifiers, predicted):
+        printStatus('{0} / {1}: {2:.1f}% agree'.format(first, second, 100 * fraction))
+    printStatus(str(datetime.now()) + ' {0} images, histograms {1:.1f} s, '
+                'prediction {2:.1f} s'.format(len(imgs), timings['histograms'],
+                                              timings['featuremap_predict']))
+    writeStats(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
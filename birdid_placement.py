@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+""" Put classified images into their per-class folders
+
+ImagePlacer copies (or links, or moves) images on a small thread pool, so
+placement of one batch overlaps classification of the next one. On network
+storage the copies can otherwise take longer than the classification.
+"""
+
+import errno
+import filecmp
+import threading
+import time
+from os import link, remove, symlink
+from os.path import abspath, basename, exists, getsize, join, lexists, splitext
+from shutil import copyfile, move
+import birdid_stats
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+PLACEMENT_MODES = ('copy', 'hardlink', 'symlink', 'reflink', 'move')
+COLLISION_POLICIES = ('overwrite', 'rename', 'skip')
+
+# ioctl request to clone a file's extents on Linux (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+
+def reflinkfile(src, dst):
+    """ Copy-on-write clone of src to dst, or a plain copy where unsupported """
+    if fcntl is not None:
+        try:
+            with open(src, 'rb') as source:
+                with open(dst, 'wb') as dest:
+                    fcntl.ioctl(dest.fileno(), FICLONE, source.fileno())
+            return
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL,
+                               errno.ENOTTY, errno.EBADF):
+                raise
+    copyfile(src, dst)
+
+
+def placeFile(src, dst, mode='copy'):
+    """ Put src at dst, replacing whatever is there, according to mode """
+    # Unlink first: copying onto a hard or symbolic link left by an earlier
+    # run would overwrite the file it points to
+    if lexists(dst):
+        remove(dst)
+    if mode == 'copy':
+        copyfile(src, dst)
+    elif mode == 'hardlink':
+        link(src, dst)
+    elif mode == 'symlink':
+        symlink(abspath(src), dst)
+    elif mode == 'reflink':
+        reflinkfile(src, dst)
+    elif mode == 'move':
+        move(src, dst)
+    else:
+        raise ValueError('placement mode {0} not known or understood'.format(mode))
+
+
+class ImagePlacer(object):
+    """ Places images into the folders in pathToClass on worker threads
+
+    Destination names are decided in submit, in submission order, so the
+    outcome of name collisions does not depend on thread timing. With
+    collision 'overwrite' an existing file of the same name is replaced (as
+    copyfile always did), with 'rename' the image gets the first free name
+    NAME-1.EXT, NAME-2.EXT, ..., and with 'skip' it is not placed.
+    """
+
+    def __init__(self, pathToClass, mode='copy', workers=4, collision='overwrite'):
+        if mode not in PLACEMENT_MODES:
+            raise ValueError('placement mode {0} not known or understood'.format(mode))
+        if collision not in COLLISION_POLICIES:
+            raise ValueError('collision policy {0} not known or understood'.format(collision))
+        self.pathToClass = pathToClass
+        self.mode = mode
+        self.collision = collision
+        from multiprocessing.pool import ThreadPool
+        self.pool = ThreadPool(workers)
+        self.pending = []
+        self.reserved = {}
+        self.lock = threading.Lock()
+        self.aborted = threading.Event()
+        self.files = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.busy = 0.0  # thread-seconds spent placing files
+
+    def destination(self, src, classIndex):
+        """ Where src goes, or None if the collision policy skips it """
+        folder = self.pathToClass[classIndex]
+        dst = join(folder, basename(src))
+        if self.collision == 'overwrite' or not (dst in self.reserved or exists(dst)):
+            return dst
+        if self.collision == 'skip':
+            return None
+        stem, extension = splitext(basename(src))
+        n = 1
+        while True:
+            dst = join(folder, '{0}-{1}{2}'.format(stem, n, extension))
+            if dst not in self.reserved and not exists(dst):
+                return dst
+            n += 1
+
+    def placedBefore(self, src, classIndex):
+        """ Whether the 'rename' policy already placed src in an earlier run
+
+        That is, whether one of the names it would have given src (NAME.EXT,
+        NAME-1.EXT, ...) in the class folder has the same contents.
+        """
+        folder = self.pathToClass[classIndex]
+        stem, extension = splitext(basename(src))
+        dst = join(folder, basename(src))
+        n = 0
+        while exists(dst):
+            if filecmp.cmp(src, dst, shallow=False):
+                return True
+            n += 1
+            dst = join(folder, '{0}-{1}{2}'.format(stem, n, extension))
+        return False
+
+    def skip(self, src):
+        """ Leave src out, counting it among the skipped images """
+        self.skipped += 1
+
+    def submit(self, src, classIndex):
+        dst = self.destination(src, classIndex)
+        if dst is None:
+            self.skip(src)
+            return
+        if dst in self.reserved:
+            # Overwriting a file placed earlier in this run: let that finish
+            # first so the later image deterministically wins
+            self.reserved[dst].wait()
+        self.reserved[dst] = self.pool.apply_async(self._place, (src, dst))
+        self.pending.append(self.reserved[dst])
+
+    def _place(self, src, dst):
+        if self.aborted.is_set():
+            return
+        size = getsize(src)
+        began = time.time()
+        with birdid_stats.stage('place'):
+            placeFile(src, dst, self.mode)
+        birdid_stats.count('placed_bytes', size)
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+            self.busy += time.time() - began
+
+    def wait(self):
+        """ Block until everything submitted is placed; re-raises failures """
+        try:
+            for result in self.pending:
+                result.get()
+        finally:
+            self.pending = []
+
+    def abort(self):
+        """ Drop submitted images that have not been started yet """
+        self.aborted.set()
+        self.wait()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def summary(self):
+        # The threads sit idle while the next batch is classified, so the
+        # rate is over the time they actually spent placing files
+        rate = self.bytes / self.busy / float(1 << 20) if self.busy > 0 else 0.0
+        text = 'Placed {0} images ({1:.1f} MB, {2}) at {3:.1f} MB/s per thread'.format(
+            self.files, self.bytes / float(1 << 20), self.mode, rate)
+        if self.skipped:
+            text += ', skipped {0} existing'.format(self.skipped)
+        return text
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+""" Index of the trained models in a model directory
+
+phow_train.py leaves four files per model in its data directory:
+IDENTIFIER-vocab.py.mat and IDENTIFIER-hists.py.mat, shared by every model
+trained on that vocabulary, and PREFIX-IDENTIFIER-model.py.mat and
+PREFIX-IDENTIFIER-result for each model; birdid_bundle can add a
+PREFIX-IDENTIFIER.birdid bundle that replaces the other three.
+ModelRegistry keeps an index of them in MODELDIR/.birdid-models.json with
+the size, mtime and SHA-1 of every file and the key settings of every
+model, so listing the models of a directory on a slow share is one
+listdir and a stat per file. Files are only hashed and parsed again when
+their size or mtime changes.
+
+    python birdid_registry.py MODELDIR [--validate]
+"""
+
+import argparse
+import hashlib
+import json
+import re
+import sys
+from cPickle import load
+from os import listdir, rename, stat
+from os.path import join
+
+INDEX_NAME = '.birdid-models.json'
+INDEX_VERSION = 1
+
+# The prefix is everything before the first '-', as phow_train.py names it
+_PATTERNS = (('vocab', re.compile(r'^(?P<identifier>.+)-vocab\.py\.mat$')),
+             ('hists', re.compile(r'^(?P<identifier>.+)-hists\.py\.mat$')),
+             ('model', re.compile(r'^(?P<prefix>[^-]+)-(?P<identifier>.+)-model\.py\.mat$')),
+             ('result', re.compile(r'^(?P<prefix>[^-]+)-(?P<identifier>.+)-result$')),
+             ('bundle', re.compile(r'^(?P<prefix>[^-]+)-(?P<identifier>.+)\.birdid$')))
+
+# Files a model can't be loaded without, unless it has a bundle
+REQUIRED = ('result', 'model', 'vocab')
+
+
+def parseModelFileName(fname):
+    """ (kind, identifier, prefix) of a model file name, or None
+
+    prefix is None for the vocab and hists files, which belong to an
+    identifier rather than to one model.
+    """
+    for kind, pattern in _PATTERNS:
+        match = pattern.match(fname)
+        if match:
+            groups = match.groupdict()
+            return kind, groups['identifier'], groups.get('prefix')
+    return None
+
+
+def hashFile(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _plain(value):
+    # JSON-able copy of configuration values, which may be numpy types
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    return value
+
+
+def describeResult(path):
+    """ Key settings of the Configuration pickled in a result file """
+    with open(path, 'rb') as fp:
+        conf = load(fp)
+    phowOpts = conf.phowOpts
+    svm = getattr(conf, 'svm', None)
+    return {'classes': [str(c) for c in getattr(conf, 'classes', [])],
+            'numWords': _plain(conf.numWords),
+            'numSpatialX': _plain(conf.numSpatialX),
+            'numSpatialY': _plain(conf.numSpatialY),
+            'quantizer': getattr(conf, 'quantizer', 'vq'),
+            'phowOpts': {'Sizes': _plain(phowOpts.Sizes),
+                         'Step': _plain(phowOpts.Step),
+                         'MaxDescriptors': _plain(getattr(phowOpts, 'MaxDescriptors', None))},
+            'svmC': _plain(getattr(svm, 'C', None))}
+
+
+def describeVocab(path):
+    """ Shape of the vocabulary in a vocab file, read without loading it """
+    from scipy.io import whosmat
+    for name, shape, _ in whosmat(path):
+        if name == 'vocab':
+            return {'vocabShape': list(shape)}
+    return {}
+
+
+def describeBundle(path):
+    """ describeResult and describeVocab for a bundle, from its header """
+    from birdid_bundle import readBundle
+    header, arrays = readBundle(path)
+    description = dict(header['config'])
+    description['classes'] = header['classes']
+    description['vocabShape'] = list(arrays['vocab'].shape)
+    return description
+
+
+_DESCRIBE = {'result': describeResult, 'vocab': describeVocab,
+             'bundle': describeBundle}
+
+
+class ModelRegistry(object):
+    """ The models of modelDir, from the index file, kept up to date by update()
+
+    hashFiles=False skips the SHA-1 of new or changed files (the entries
+    then have sha1 None), for directories where even reading each changed
+    file once is too slow.
+    """
+
+    def __init__(self, modelDir, hashFiles=True):
+        self.modelDir = modelDir
+        self.hashFiles = hashFiles
+        self.indexPath = join(modelDir, INDEX_NAME)
+        self.files = {}
+        try:
+            with open(self.indexPath) as fp:
+                index = json.load(fp)
+            if index.get('version') == INDEX_VERSION:
+                self.files = index['files']
+        except (IOError, ValueError, KeyError):
+            pass  # no index yet, or unreadable: rebuilt by update
+
+    def update(self):
+        """ Bring the index up to date with the directory; True if it changed """
+        files = {}
+        changed = False
+        for fname in listdir(self.modelDir):
+            parsed = parseModelFileName(fname)
+            if parsed is None:
+                continue
+            info = stat(join(self.modelDir, fname))
+            entry = self.files.get(fname)
+            if entry is None or entry['size'] != info.st_size or \
+                    entry['mtime'] != info.st_mtime or \
+                    (self.hashFiles and entry['sha1'] is None):
+                entry = self._describeFile(fname, parsed, info)
+                changed = True
+            files[fname] = entry
+        if changed or set(files) != set(self.files):
+            self.files = files
+            self._save()
+            return True
+        return False
+
+    def _describeFile(self, fname, parsed, info):
+        kind, identifier, prefix = parsed
+        path = join(self.modelDir, fname)
+        entry = {'kind': kind, 'identifier': identifier, 'prefix': prefix,
+                 'size': info.st_size, 'mtime': info.st_mtime,
+                 'sha1': hashFile(path) if self.hashFiles else None}
+        if kind in _DESCRIBE:
+            try:
+                entry.update(_DESCRIBE[kind](path))
+            except Exception as e:
+                # Still listed, but reported as a problem by models()
+                entry['error'] = repr(e)
+        return entry
+
+    def _save(self):
+        temp = self.indexPath + '.tmp'
+        try:
+            with open(temp, 'w') as fp:
+                json.dump({'version': INDEX_VERSION, 'files': self.files}, fp,
+                          indent=1, sort_keys=True)
+            rename(temp, self.indexPath)
+        except (IOError, OSError):
+            pass  # read-only model directory: index again next time
+
+    def models(self):
+        """ Every (identifier, prefix) with a model or result file, sorted
+
+        Each model is a dict with identifier, prefix, files (kind to file
+        name), config (from the result and vocab files), and problems, a
+        list of what is missing or unreadable; complete is True when
+        there are none.
+        """
+        byIdentifier = {}
+        for fname, entry in self.files.items():
+            byIdentifier.setdefault(entry['identifier'], {}).setdefault(
+                entry['prefix'], {})[entry['kind']] = fname
+
+        models = []
+        for identifier, byPrefix in sorted(byIdentifier.items()):
+            shared = byPrefix.pop(None, {})
+            for prefix, own in sorted(byPrefix.items()):
+                files = dict(shared)
+                files.update(own)
+                config = {}
+                problems = []
+                for kind in () if 'bundle' in files else REQUIRED:
+                    if kind not in files:
+                        problems.append('no {0} file'.format(kind))
+                for kind, fname in sorted(files.items()):
+                    entry = self.files[fname]
+                    if 'error' in entry:
+                        problems.append('{0}: {1}'.format(fname, entry['error']))
+                    config.update((key, value) for key, value in entry.items()
+                                  if key not in ('kind', 'identifier', 'prefix',
+                                                 'size', 'mtime', 'sha1', 'error'))
+                if 'vocabShape' in config and 'numWords' in config and \
+                        config['vocabShape'][-1] != config['numWords']:
+                    problems.append('vocabulary has {0} words, configuration {1}'.format(
+                        config['vocabShape'][-1], config['numWords']))
+                models.append({'identifier': identifier, 'prefix': prefix,
+                               'files': files, 'config': config,
+                               'problems': problems, 'complete': not problems})
+        return models
+
+    def identifiers(self, complete=True):
+        """ Sorted identifiers that have a (complete) model """
+        return sorted(set(m['identifier'] for m in self.models()
+                          if m['complete'] or not complete))
+
+    def prefixes(self, identifier, complete=True):
+        """ Sorted prefixes of the (complete) models of identifier """
+        return [m['prefix'] for m in self.models()
+                if m['identifier'] == identifier and (m['complete'] or not complete)]
+
+    def validate(self, identifier, prefix):
+        """ Problems with a model, checking its files against their hashes """
+        for model in self.models():
+            if model['identifier'] == identifier and model['prefix'] == prefix:
+                break
+        else:
+            return ['no model {0}-{1}'.format(prefix, identifier)]
+        problems = list(model['problems'])
+        for kind, fname in sorted(model['files'].items()):
+            entry = self.files[fname]
+            try:
+                info = stat(join(self.modelDir, fname))
+            except OSError:
+                problems.append(fname + ' is gone')
+                continue
+            if info.st_size != entry['size']:
+                problems.append(fname + ' changed size')
+            elif entry['sha1'] is not None and \
+                    hashFile(join(self.modelDir, fname)) != entry['sha1']:
+                problems.append(fname + ' does not match its hash')
+        return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('modelDir', help='directory containing the model files')
+    parser.add_argument('--validate', action='store_true',
+                        help='also check every file against its hash')
+    parser.add_argument('--no-hash', action='store_true',
+                        help="don't hash new or changed files")
+    args = parser.parse_args(argv)
+
+    registry = ModelRegistry(args.modelDir, hashFiles=not args.no_hash)
+    registry.update()
+    status = 0
+    for model in registry.models():
+        problems = model['problems']
+        if args.validate and model['complete']:
+            problems = registry.validate(model['identifier'], model['prefix'])
+        config = model['config']
+        sys.stdout.write('{0}\t{1}\t{2} words\t{3} classes\t{4}\n'.format(
+            model['identifier'], model['prefix'], config.get('numWords', '?'),
+            len(config.get('classes', [])), '; '.join(problems) or 'ok'))
+        if problems:
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+""" Local classification server that keeps a model loaded
+
+Loading a model (configuration, SVM and vocabulary) and importing scipy
+and sklearn dominates the run time of small classification jobs. This
+server loads one model once and then answers requests over HTTP on
+localhost, so a request only pays for feature extraction and prediction.
+
+    python birdid_server.py serve MODELDIR IDENTIFIER PREFIX --port 8008
+    python birdid_server.py classify --port 8008 IMAGE_OR_DIR [...]
+
+POST /classify with {"paths": [...]} returns {"predictions": [{"path": ...,
+"class": ..., "index": ...}, ...]}; directories are expanded to the images
+they contain. GET /status describes the loaded model. Requests that arrive
+within batchWindow seconds of each other are classified together.
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+import urllib2
+import Queue
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from os.path import isdir
+from birdid_utils import get_imgfiles
+from birdid_classify import Classifier, printStatus
+
+
+class _Request(object):
+    # One client request waiting for its share of a batch
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.done = threading.Event()
+        self.predictions = None
+        self.error = None
+
+
+class BatchClassifier(object):
+    """ Classifies queued requests in batches on a single worker thread
+
+    The worker waits for a request, then keeps collecting requests for up
+    to batchWindow seconds or until maxBatch images are queued, and
+    classifies them with one histograms/predict call.
+    """
+
+    def __init__(self, classifier, batchWindow=0.05, maxBatch=64, cache=None):
+        self.classifier = classifier
+        self.batchWindow = batchWindow
+        self.maxBatch = maxBatch
+        self.cache = cache
+        self.requests = Queue.Queue()
+        self.imagesClassified = 0
+        self.batches = 0
+        self.worker = threading.Thread(target=self._run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def classify(self, paths):
+        """ Predicted class index of each image path; blocks until done """
+        request = _Request(paths)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.predictions
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            numImages = len(batch[0].paths)
+            deadline = time.time() + self.batchWindow
+            while numImages < self.maxBatch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=remaining)
+                except Queue.Empty:
+                    break
+                batch.append(request)
+                numImages += len(request.paths)
+            self._classifyBatch(batch)
+
+    def _classifyBatch(self, batch):
+        imgs = [path for request in batch for path in request.paths]
+        try:
+            predicted = []
+            if imgs:
+                hists = self.classifier.histograms(imgs, cache=self.cache)
+                predicted = list(self.classifier.predict(hists))
+        except Exception as e:
+            if len(batch) > 1:
+                # Don't fail every request for one unreadable image
+                for request in batch:
+                    self._classifyBatch([request])
+                return
+            batch[0].error = e
+            batch[0].done.set()
+            return
+
+        self.batches += 1
+        self.imagesClassified += len(imgs)
+        start = 0
+        for request in batch:
+            request.predictions = predicted[start:start + len(request.paths)]
+            start += len(request.paths)
+            request.done.set()
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def _reply(self, code, body):
+        data = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/status':
+            self._reply(404, {'error': 'unknown path ' + self.path})
+            return
+        server = self.server
+        classifier = server.batcher.classifier
+        self._reply(200, {'modelDir': classifier.modelDir,
+                          'identifier': classifier.identifier,
+                          'prefix': classifier.prefix,
+                          'classes': [str(c) for c in classifier.classes],
+                          'images': server.batcher.imagesClassified,
+                          'batches': server.batcher.batches,
+                          'uptime': time.time() - server.started})
+
+    def do_POST(self):
+        if self.path != '/classify':
+            self._reply(404, {'error': 'unknown path ' + self.path})
+            return
+        began = time.time()
+        try:
+            length = int(self.headers.getheader('Content-Length', 0))
+            paths = json.loads(self.rfile.read(length))['paths']
+            if isinstance(paths, basestring):
+                paths = [paths]
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {'error': 'bad request: ' + str(e)})
+            return
+
+        classifier = self.server.batcher.classifier
+        imgs = []
+        for path in paths:
+            if isdir(path):
+                imgs.extend(get_imgfiles(path, classifier.conf.extensions))
+            else:
+                imgs.append(path)
+        try:
+            predicted = self.server.batcher.classify(imgs)
+        except Exception as e:
+            self._reply(500, {'error': repr(e)})
+            return
+        self._reply(200, {
+            'predictions': [{'path': path, 'index': int(index),
+                             'class': str(classifier.classes[index])}
+                            for path, index in zip(imgs, predicted)],
+            'seconds': time.time() - began})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class ClassifierServer(ThreadingMixIn, HTTPServer):
+    """ HTTP server answering /classify and /status for one BatchClassifier """
+    daemon_threads = True
+
+    def __init__(self, batcher, host='127.0.0.1', port=8008, verbose=False):
+        HTTPServer.__init__(self, (host, port), _Handler)
+        self.batcher = batcher
+        self.verbose = verbose
+        self.started = time.time()
+
+
+def classifyRemote(paths, host='127.0.0.1', port=8008, timeout=None):
+    """ Ask a running server to classify paths; returns its prediction list """
+    if isinstance(paths, basestring):
+        paths = [paths]
+    request = urllib2.Request('http://{0}:{1}/classify'.format(host, port),
+                              json.dumps({'paths': paths}),
+                              {'Content-Type': 'application/json'})
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as e:
+        raise ValueError('server error: ' + e.read())
+    return json.loads(response.read())['predictions']
+
+
+def serve(args):
+    classifier = Classifier(args.modelDir, args.identifier, args.prefix,
+                            status=printStatus)
+    if args.jobs > 1:
+        classifier.startPool(args.jobs)
+    cache = classifier.openCache(args.cache_dir) if args.cache_dir else None
+    batcher = BatchClassifier(classifier, args.batch_window, args.max_batch, cache)
+    server = ClassifierServer(batcher, args.host, args.port, args.verbose)
+    printStatus('Serving {0}-{1} on http://{2}:{3}/'.format(
+        args.prefix, args.identifier, *server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        classifier.stopPool()
+    return 0
+
+
+def classify(args):
+    for prediction in classifyRemote(args.paths, args.host, args.port):
+        sys.stdout.write(prediction['path'] + '\t' + prediction['class'] + '\n')
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8008)
+    commands = parser.add_subparsers()
+
+    serveParser = commands.add_parser('serve', help='load a model and serve it')
+    serveParser.add_argument('modelDir')
+    serveParser.add_argument('identifier')
+    serveParser.add_argument('prefix')
+    serveParser.add_argument('--jobs', type=int, default=1,
+                             help='resident worker processes for feature extraction')
+    serveParser.add_argument('--batch-window', type=float, default=0.05,
+                             help='seconds to wait for more requests to batch')
+    serveParser.add_argument('--max-batch', type=int, default=64,
+                             help='images per batch')
+    serveParser.add_argument('--cache-dir',
+                             help='keep image histograms in this directory')
+    serveParser.add_argument('--verbose', action='store_true',
+                             help='log every request')
+    serveParser.set_defaults(run=serve)
+
+    classifyParser = commands.add_parser(
+        'classify', help='classify images with a running server')
+    classifyParser.add_argument('paths', nargs='+',
+                                help='image files or directories of images')
+    classifyParser.set_defaults(run=classify)
+
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+""" Split the classification of one large folder across machines
+
+The listing of INPUTDIR is split into N shards by the CRC-32 of each file
+name, so every machine computes the same split on its own, whatever order
+its listing comes in and wherever the folder is mounted. Each worker
+classifies one shard and writes its predictions to SHAREDDIR:
+
+    python birdid_shard.py work MODELDIR IDENTIFIER PREFIX INPUTDIR SHAREDDIR --shard K --shards N
+
+The result file shard-K-of-N.json is written under a temporary name and
+renamed into place when the shard is finished, so its presence means the
+shard is complete; with --histograms the histograms are kept next to it
+in shard-K-of-N.hists (float32, one row per prediction). Once all
+shards are there, merge checks that they were made by the same model and
+together cover every image in INPUTDIR, then places the images:
+
+    python birdid_shard.py merge SHAREDDIR INPUTDIR OUTPUTDIR --shards N
+
+local runs N worker processes on this machine and then merges, which is
+also how to try the whole thing out:
+
+    python birdid_shard.py local MODELDIR IDENTIFIER PREFIX INPUTDIR SHAREDDIR OUTPUTDIR --shards 4
+"""
+
+import argparse
+import json
+import socket
+import subprocess
+import sys
+import time
+import zlib
+from datetime import datetime
+from os import rename
+from os.path import abspath, basename, exists, join
+from birdid_utils import get_imgfiles
+from birdid_classify import Classifier, classifyImages, createClassFolders, \
+    printStatus, classifierFingerprint
+from birdid_placement import ImagePlacer, PLACEMENT_MODES, COLLISION_POLICIES
+
+RESULT_VERSION = 1
+
+
+def shardOf(imagefname, numShards):
+    """ Shard of an image file, from its name alone """
+    name = basename(imagefname)
+    if not isinstance(name, bytes):
+        name = name.encode('utf-8')
+    # crc32 is signed on Python 2
+    return (zlib.crc32(name) & 0xffffffff) % numShards
+
+
+def _listedName(name):
+    # File names come back from the JSON result files as unicode; the
+    # listing has them as str, which on Python 2 are UTF-8 bytes
+    if not isinstance(name, str):
+        name = name.encode('utf-8')
+    return name
+
+
+def shardImages(imgs, shard, numShards):
+    """ The images of imgs in shard, sorted by name """
+    return sorted((imagefname for imagefname in imgs
+                   if shardOf(imagefname, numShards) == shard), key=basename)
+
+
+def resultPath(sharedDir, shard, numShards):
+    return join(sharedDir, 'shard-{0}-of-{1}.json'.format(shard, numShards))
+
+
+def histogramsPath(sharedDir, shard, numShards):
+    return join(sharedDir, 'shard-{0}-of-{1}.hists'.format(shard, numShards))
+
+
+def runShard(classifier, inputDir, sharedDir, shard, numShards, jobs=1,
+             batchSize=0, keepHistograms=False, status=printStatus):
+    """ Classify one shard of inputDir and write its result file; returns its path """
+    imgs = shardImages(get_imgfiles(inputDir, classifier.conf.extensions),
+                       shard, numShards)
+    status(str(datetime.now()) + ' Shard {0} of {1}: {2} images'.format(
+        shard, numShards, len(imgs)))
+    began = time.time()
+    histograms = None
+    if keepHistograms and imgs:
+        histograms = histogramsPath(sharedDir, shard, numShards)
+    predicted, timings = classifyImages(
+        classifier, imgs, None, jobs=jobs, batchSize=batchSize, dryRun=True,
+        status=status,
+        histogramPath=None if histograms is None else histograms + '.tmp')
+    if histograms is not None:
+        rename(histograms + '.tmp', histograms)
+
+    result = {'version': RESULT_VERSION, 'shard': shard, 'shards': numShards,
+              'fingerprint': classifierFingerprint(classifier),
+              'model': classifier.prefix + '-' + classifier.identifier,
+              'classes': [str(c) for c in classifier.classes],
+              'extensions': list(classifier.conf.extensions),
+              'images': [basename(imagefname) for imagefname in imgs],
+              'predicted': [int(classIndex) for classIndex in predicted],
+              'histograms': None if histograms is None else basename(histograms),
+              'host': socket.gethostname(), 'seconds': time.time() - began,
+              'stages': timings}
+    path = resultPath(sharedDir, shard, numShards)
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(result, fp, sort_keys=True)
+    rename(path + '.tmp', path)
+    return path
+
+
+def loadShards(sharedDir, numShards):
+    """ The result files of all numShards shards
+
+    Raises ValueError listing the shards that are missing, or if the
+    results were made by different models.
+    """
+    results = []
+    missing = []
+    for shard in range(numShards):
+        path = resultPath(sharedDir, shard, numShards)
+        if not exists(path):
+            missing.append(str(shard))
+            continue
+        with open(path) as fp:
+            results.append(json.load(fp))
+    if missing:
+        raise ValueError('shards {0} of {1} are not finished'.format(
+            ', '.join(missing), numShards))
+    fingerprints = set(result['fingerprint'] for result in results)
+    if len(fingerprints) > 1:
+        raise ValueError('shards were classified by different models: ' +
+                         ', '.join(sorted(set(result['model'] for result in results))))
+    return results
+
+
+def checkComplete(results, imgs, numShards):
+    """ Problems with results as the classification of imgs; empty if none
+
+    Every image must be in the result of its own shard, once, and no
+    result may name an image that is not in imgs.
+    """
+    problems = []
+    expected = set(basename(imagefname) for imagefname in imgs)
+    seen = set()
+    for result in results:
+        for name in map(_listedName, result['images']):
+            if shardOf(name, numShards) != result['shard']:
+                problems.append('{0} is in shard {1}, should be in {2}'.format(
+                    name, result['shard'], shardOf(name, numShards)))
+            elif name in seen:
+                problems.append(name + ' was classified twice')
+            elif name not in expected:
+                problems.append(name + ' is no longer in the input folder')
+            seen.add(name)
+    for name in sorted(expected - seen):
+        problems.append('{0} (shard {1}) was not classified'.format(
+            name, shardOf(name, numShards)))
+    return problems
+
+
+def mergeShards(sharedDir, inputDir, destFolder, numShards, placement='copy',
+                placementWorkers=4, collision='overwrite', status=printStatus):
+    """ Check the shard results against inputDir and place every image
+
+    Raises ValueError if shards are missing, disagree, or don't cover the
+    images now in inputDir; nothing is placed then. Returns the number of
+    images placed.
+    """
+    results = loadShards(sharedDir, numShards)
+    # List the folder the way the workers did
+    imgs = get_imgfiles(inputDir, results[0]['extensions'])
+    problems = checkComplete(results, imgs, numShards)
+    if problems:
+        raise ValueError('{0} problems with the shard results, e.g. {1}'.format(
+            len(problems), '; '.join(problems[:5])))
+
+    classes = results[0]['classes']
+    pathToClass = createClassFolders(destFolder, classes, status)
+    placer = ImagePlacer(pathToClass, placement, placementWorkers, collision)
+    # Sorted, so 'rename' collisions come out the same on every merge
+    placements = sorted((_listedName(name), classIndex) for result in results
+                        for name, classIndex in zip(result['images'], result['predicted']))
+    try:
+        for name, classIndex in placements:
+            placer.submit(join(inputDir, name), classIndex)
+        placer.wait()
+    finally:
+        placer.close()
+    status(str(datetime.now()) + ' ' + placer.summary())
+    return len(placements)
+
+
+def addWorkArguments(parser):
+    parser.add_argument('modelDir', help='directory containing the model files')
+    parser.add_argument('identifier', help='model identifier')
+    parser.add_argument('prefix', help='model prefix')
+    parser.add_argument('inputDir', help='directory of images to classify')
+    parser.add_argument('sharedDir', help='directory the shard results go to')
+
+
+def addMergeArguments(parser):
+    parser.add_argument('outputDir', help='directory for the per-class folders')
+    parser.add_argument('--place', choices=PLACEMENT_MODES, default='copy',
+                        help='how images get into the class folders')
+    parser.add_argument('--place-workers', type=int, default=4,
+                        help='threads placing images')
+    parser.add_argument('--on-collision', choices=COLLISION_POLICIES,
+                        default='overwrite',
+                        help='what to do when the destination name exists')
+
+
+def runWork(args):
+    classifier = Classifier(args.modelDir, args.identifier, args.prefix,
+                            status=printStatus)
+    path = runShard(classifier, args.inputDir, args.sharedDir, args.shard,
+                    args.shards, args.jobs, args.batch_size, args.histograms)
+    sys.stdout.write(path + '\n')
+    return 0
+
+
+def runMerge(args):
+    try:
+        placed = mergeShards(args.sharedDir, args.inputDir, args.outputDir,
+                             args.shards, args.place,
+                             args.place_workers, args.on_collision)
+    except ValueError as e:
+        printStatus(str(e))
+        return 1
+    sys.stdout.write(json.dumps({'images': placed, 'shards': args.shards}) + '\n')
+    return 0
+
+
+def runLocal(args):
+    workers = []
+    for shard in range(args.shards):
+        if exists(resultPath(args.sharedDir, shard, args.shards)):
+            continue  # finished by an earlier run
+        command = [sys.executable, abspath(__file__), 'work', args.modelDir,
+                   args.identifier, args.prefix, args.inputDir, args.sharedDir,
+                   '--shard', str(shard), '--shards', str(args.shards),
+                   '--jobs', str(args.jobs), '--batch-size', str(args.batch_size)]
+        if args.histograms:
+            command.append('--histograms')
+        workers.append((shard, subprocess.Popen(command)))
+    failed = [str(shard) for shard, worker in workers if worker.wait() != 0]
+    if failed:
+        printStatus('shards {0} failed'.format(', '.join(failed)))
+        return 1
+    return runMerge(args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers()
+
+    work = commands.add_parser('work', help='classify one shard')
+    addWorkArguments(work)
+    work.add_argument('--shard', type=int, required=True, help='shard to classify, from 0')
+    work.set_defaults(run=runWork)
+
+    merge = commands.add_parser('merge', help='check the shard results and place the images')
+    merge.add_argument('sharedDir', help='directory holding the shard results')
+    merge.add_argument('inputDir', help='directory of the classified images')
+    addMergeArguments(merge)
+    merge.set_defaults(run=runMerge)
+
+    local = commands.add_parser('local', help='run every shard here, then merge')
+    addWorkArguments(local)
+    addMergeArguments(local)
+    local.set_defaults(run=runLocal)
+
+    for command in (work, merge, local):
+        command.add_argument('--shards', type=int, required=True, help='number of shards')
+    for command in (work, local):
+        command.add_argument('--jobs', type=int, default=1,
+                             help='worker processes for feature extraction, per shard')
+        command.add_argument('--batch-size', type=int, default=0,
+                             help='images per batch, 0 for a single batch')
+        command.add_argument('--histograms', action='store_true',
+                             help='keep the histograms of each shard')
+
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+""" Optional per-stage timing and counters for the classification pipeline
+
+Nothing is recorded until enable() is called. While disabled, stage()
+hands out one shared do-nothing context manager and count() returns
+after a single check, so the instrumented code in birdid_utils and
+vl_phow costs a function call per stage.
+
+    birdid_stats.enable()
+    ... classify ...
+    birdid_stats.current().writePrometheus('birdid.prom')
+
+Stages record calls, wall time and CPU time. CPU time is that of the
+whole process (os.times), so for stages run on threads it includes the
+other threads. Worker processes started by openHistogramPool record into
+their own Stats, which are merged back with each histogram.
+"""
+
+import json
+import threading
+import time
+from os import rename, times
+
+
+class Stats(object):
+    """ Accumulated stage times and counters
+
+    stages maps a stage name to [calls, wall seconds, CPU seconds] and
+    counters a counter name to its total.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+
+    def addStage(self, name, calls, wall, cpu):
+        with self.lock:
+            totals = self.stages.setdefault(name, [0, 0.0, 0.0])
+            totals[0] += calls
+            totals[1] += wall
+            totals[2] += cpu
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, snapshot):
+        """ Add a snapshot of another Stats, e.g. from a worker process """
+        for name, totals in snapshot['stages'].items():
+            self.addStage(name, *totals)
+        for name, value in snapshot['counters'].items():
+            self.add(name, value)
+
+    def snapshot(self):
+        with self.lock:
+            return {'stages': dict((name, list(totals))
+                                   for name, totals in self.stages.items()),
+                    'counters': dict(self.counters)}
+
+    def summary(self):
+        """ Snapshot plus the rates derived from it """
+        result = self.snapshot()
+        stages, counters = result['stages'], result['counters']
+        result['elapsed'] = time.time() - self.started
+        if 'histograms' in stages and stages['histograms'][1] > 0:
+            result['images_per_second'] = counters.get('images', 0) / stages['histograms'][1]
+        if counters.get('features'):
+            result['descriptors_per_image'] = \
+                counters.get('descriptors', 0) / float(counters['features'])
+        if 'worker' in stages and counters.get('pool_seconds'):
+            result['worker_utilization'] = stages['worker'][1] / counters['pool_seconds']
+        return result
+
+    def writeJSONLine(self, path, **extra):
+        """ Append the summary, and any extra fields, as one JSON line """
+        record = self.summary()
+        record['time'] = time.time()
+        record.update(extra)
+        with open(path, 'a') as fp:
+            fp.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def writePrometheus(self, path, prefix='birdid'):
+        """ Write the summary in the Prometheus text exposition format
+
+        The file is replaced atomically, as the node exporter's textfile
+        collector expects.
+        """
+        summary = self.summary()
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP {0}_{1} {2}'.format(prefix, name, help))
+            lines.append('# TYPE {0}_{1} {2}'.format(prefix, name, kind))
+            for labels, value in samples:
+                lines.append('{0}_{1}{2} {3!r}'.format(prefix, name, labels, float(value)))
+
+        stages = sorted(summary['stages'].items())
+        for column, name, help in ((0, 'stage_calls_total', 'Calls of each stage'),
+                                   (1, 'stage_seconds_total', 'Wall time in each stage'),
+                                   (2, 'stage_cpu_seconds_total',
+                                    'Process CPU time during each stage')):
+            metric(name, 'counter', help,
+                   [('{{stage="{0}"}}'.format(stage), totals[column])
+                    for stage, totals in stages])
+        for name, value in sorted(summary['counters'].items()):
+            metric(name + '_total', 'counter', 'Total ' + name.replace('_', ' '),
+                   [('', value)])
+        for name in ('images_per_second', 'descriptors_per_image',
+                     'worker_utilization'):
+            if name in summary:
+                metric(name, 'gauge', name.replace('_', ' ').capitalize(),
+                       [('', summary[name])])
+
+        temp = path + '.tmp'
+        with open(temp, 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+        rename(temp, path)
+
+
+class _Stage(object):
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.time()
+        cpu = times()
+        self.cpu = cpu[0] + cpu[1]
+
+    def __exit__(self, *exc):
+        cpu = times()
+        self.stats.addStage(self.name, 1, time.time() - self.wall,
+                            cpu[0] + cpu[1] - self.cpu)
+        return False
+
+
+class _NoStage(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOSTAGE = _NoStage()
+_current = None
+
+
+def enable(stats=None):
+    """ Start recording into stats (a new Stats by default) and return it """
+    global _current
+    _current = stats if stats is not None else Stats()
+    return _current
+
+
+def disable():
+    global _current
+    _current = None
+
+
+def current():
+    """ The Stats being recorded into, or None while disabled """
+    return _current
+
+
+def stage(name):
+    """ Context manager timing the code inside it as stage name """
+    if _current is None:
+        return _NOSTAGE
+    return _Stage(_current, name)
+
+
+def count(name, value=1):
+    if _current is not None:
+        _current.add(name, value)
+
+
+def timed(name):
+    """ Decorator timing every call of a function as stage name """
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            if _current is None:
+                return function(*args, **kwargs)
+            with _Stage(_current, name):
+                return function(*args, **kwargs)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorator
+
+
+def collect():
+    """ Snapshot of what was recorded since the last collect, or None
+
+    Used by worker processes to send their numbers back with each result.
+    """
+    global _current
+    if _current is None:
+        return None
+    snapshot = _current.snapshot()
+    _current = Stats()
+    return snapshot
+
+
+def merge(snapshot):
+    if _current is not None and snapshot is not None:
+        _current.merge(snapshot)
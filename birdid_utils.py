@@ -8,16 +8,18 @@ from os.path import exists, isdir, basename, join, splitext
 from os import makedirs
 from glob import glob
 from random import sample, seed
-from scipy import ones, mod, arange, array, where, ndarray, hstack, linspace, histogram, vstack, amax, amin
-from scipy.misc import imread, imresize
-from scipy.cluster.vq import vq
+from numpy import ones, mod, arange, array, where, ndarray, hstack, vstack, amax, amin
 import numpy
-from vl_phow import vl_phow
-from vlfeat import vl_ikmeans
-import pylab as pl
 from datetime import datetime
-import multiprocessing
 import sys
+from collections import deque
+import time
+import birdid_stats
+
+# vlfeat, PIL, multiprocessing and the scipy submodules are imported where
+# they are first needed, so that importing this module (for the GUI, the
+# command line tools or spawned pool workers) stays cheap. See
+# "birdid_bench.py imports".
 
 
 SAVETODISC = False
@@ -25,6 +27,10 @@ FEATUREMAP = True
 TINYPROBLEM = False
 VERBOSE = True  # set to 'SVM' if you want to get the svm output
 MULTIPROCESSING = False
+FUSEDPHOW = True  # vl_phow fused mode: same features, less work for gray images
+# loadImage decodes large JPEGs at reduced scale. Faster, but the pixels
+# differ slightly from the full decode models were trained on
+FASTDECODE = False
 
 
 class Configuration(object):
@@ -44,18 +50,28 @@ class Configuration(object):
         # class
         self.numTrain = 30
         self.numTest = 15
-        self.numCore = multiprocessing.cpu_count()
+        self.numCore = cpu_count()
         self.imagesperclass = self.numTrain + self.numTest
         self.numClasses = 9
         self.numWords = 600
         self.numSpatialX = [2, 4]
         self.numSpatialY = [2, 4]
-        self.quantizer = 'vq'  # kdtree from the .m version not implemented
+        # 'vq' (brute force), 'gemm' (brute force as a matrix product,
+        # same words as vq) or 'kdtree'
+        self.quantizer = 'vq'
+        # gemm only: images whose descriptors computeHistograms quantizes
+        # together in one batch of matrix products
+        self.quantizeBatch = 8
+        # kdtree only: 0 gives exact nearest words, larger values trade
+        # accuracy for speed (words are within (1 + eps) of the nearest)
+        self.kdtreeEps = 0.0
         self.svm = SVMParameters(C=10)
 
         # These dsift sizes are the best for the all species tests 
         self.phowOpts = PHOWOptions(Verbose=False, Sizes=[2,4,6,8],
             Step=3)
+        # To bound the per-image cost on very large images, set
+        # self.phowOpts.MaxDescriptors; the step then grows as needed
         self.clobber = False
         self.tinyProblem = TINYPROBLEM
         self.prefix = prefix
@@ -64,6 +80,12 @@ class Configuration(object):
         self.extensions = [".jpg", ".jpeg", ".bmp", ".png", ".pgm", ".tif", ".tiff"]
         self.images_for_histogram = 30
         self.numbers_of_features_for_histogram = 100000
+        # 'ikmeans' (vl_ikmeans on a sample of all descriptors kept in
+        # memory), 'reservoir' (the same, sampling as descriptors are
+        # extracted in parallel) or 'minibatch' (MiniBatchKMeans on every
+        # descriptor, vocabBatchSize at a time); see trainVocabStreaming
+        self.vocabMethod = 'ikmeans'
+        self.vocabBatchSize = 10000
 
         generate_result_paths(self)
         
@@ -92,6 +114,11 @@ class Configuration(object):
 	def setClasses(self, classes):
 		self.classes = classes
 
+def cpu_count():
+    import multiprocessing
+    return multiprocessing.cpu_count()
+
+
 def generate_result_paths(conf):
     conf.vocabPath = join(conf.dataDir, conf.identifier + '-vocab.py.mat')
     conf.histPath = join(conf.dataDir, conf.identifier + '-hists.py.mat')
@@ -108,107 +135,319 @@ def ensure_type_array(data):
     return data
 
 
+def isSparse(value):
+    """ scipy.sparse.issparse, without importing scipy.sparse for dense data """
+    # Nothing can be sparse before scipy.sparse has been imported
+    sparse = sys.modules.get('scipy.sparse')
+    return sparse is not None and sparse.issparse(value)
+
+
+def pilImage():
+    """ PIL's Image module """
+    try:
+        from PIL import Image
+    except ImportError:
+        import Image
+    return Image
+
+
 def standardizeImage(im):
-    im = array(im, 'float32')
+    # float32 input, e.g. from loadImage, is used as is rather than copied;
+    # other input is converted once and then scaled in place
+    converted = not (isinstance(im, ndarray) and im.dtype == numpy.float32)
+    im = numpy.asarray(im, 'float32')
     if im.shape[0] > 480:
+        from scipy.misc import imresize
         resize_factor = 480.0 / im.shape[0]  # don't remove trailing .0 to avoid integer devision
         im = imresize(im, resize_factor)
+        converted = False
     if amax(im) > 1.1:
-        im = im / 255.0
+        if converted:
+            im /= 255.0
+        else:
+            im = im / 255.0
     assert((amax(im) > 0.01) & (amax(im) <= 1))
     assert((amin(im) >= 0.00))
     return im
 
 
+def loadImage(imagefname, maxHeight=480):
+    """ standardizeImage(imread(imagefname)), with less decoding work
+
+    Images taller than maxHeight are scaled down in PIL before converting
+    to floats, and with FASTDECODE a JPEG is decoded directly at a reduced
+    scale (draft mode) first. Like imresize on a float image, the value
+    range is stretched to 0-255 before resizing. The result is float32 in
+    [0, 1], which standardizeImage passes through without copying.
+    """
+    im = decodeImage(imagefname, maxHeight)
+    with birdid_stats.stage('standardize'):
+        return standardizeImage(im)
+
+
+@birdid_stats.timed('decode')
+def decodeImage(imagefname, maxHeight=480):
+    """ The decoding half of loadImage: a uint8 array at most maxHeight tall """
+    Image = pilImage()
+    img = Image.open(imagefname)
+    height = img.size[1]
+    if height > maxHeight:
+        # imresize's size arithmetic, so shapes match the old path
+        size = tuple((array(img.size) * (float(maxHeight) / height)).astype(int))
+        if FASTDECODE and img.format == 'JPEG':
+            img.draft(img.mode, size)
+    if img.mode not in ('L', 'RGB'):
+        img = img.convert('RGB')
+    if height > maxHeight:
+        extrema = img.getextrema()
+        if img.mode == 'L':
+            extrema = [extrema]
+        low = min(band[0] for band in extrema)
+        high = max(band[1] for band in extrema)
+        scale = 255.0 / ((high - low) or 1)
+        lut = [int(min(max((v - low) * scale, 0), 255) + 0.5) for v in range(256)]
+        img = img.point(lut * len(img.getbands())).resize(size, Image.BILINEAR)
+    return numpy.asarray(img)
+
+
+def estimateDescriptorCount(height, width, sizes, step):
+    """ Approximate number of dense SIFT descriptors vl_phow extracts """
+    sizes = ensure_type_array(sizes)
+    maxSize = max(sizes)
+    count = 0
+    for size in sizes:
+        # centres run from 1.5 * max(sizes) in to 1.5 * size from the far edge
+        numX = int((width - 1.5 * (maxSize + size)) // step) + 1
+        numY = int((height - 1.5 * (maxSize + size)) // step) + 1
+        count += max(numX, 0) * max(numY, 0)
+    return count
+
+
+def phowStep(height, width, phowOpts):
+    """ phowOpts.Step, increased until the image fits phowOpts.MaxDescriptors """
+    step = phowOpts.Step
+    # configurations pickled before the budget existed have no limit
+    budget = getattr(phowOpts, 'MaxDescriptors', None)
+    if not budget:
+        return step
+    while step < max(height, width) and \
+            estimateDescriptorCount(height, width, phowOpts.Sizes, step) > budget:
+        step += 1
+    return step
+
+
+@birdid_stats.timed('phow')
 def getPhowFeatures(imagedata, phowOpts):
+    from vl_phow import vl_phow
     im = standardizeImage(imagedata)
     frames, descrs = vl_phow(im,
                              verbose=phowOpts.Verbose,
                              sizes=phowOpts.Sizes,
-                             step=phowOpts.Step)
+                             step=phowStep(im.shape[0], im.shape[1], phowOpts),
+                             fused=FUSEDPHOW)
     return frames, descrs
 
+@birdid_stats.timed('quantize')
+def quantizeDescriptors(model, descrs):
+    """ Return the index of the nearest visual word for each column of descrs """
+    if model.quantizer == 'vq':
+        from scipy.cluster.vq import vq
+        words, _ = vq(descrs.T, model.vocab.T)
+    elif model.quantizer == 'gemm':
+        words = quantizeGemm(model, descrs)
+    elif model.quantizer == 'kdtree':
+        _, words = model.kdtree().query(descrs.T, k=1, eps=model.kdtreeEps)
+    else:
+        raise ValueError('quantizer {0} not known or understood'.format(model.quantizer))
+    return words
+
+
+def quantizeGemm(model, descrs, chunkSize=8192):
+    """ Nearest visual words by matrix products, chunkSize descriptors at a time
+
+    The nearest word v to a descriptor d minimizes |v|^2 - 2 d.v, so the
+    distances to all words are one matrix product plus the precomputed
+    norms (see Model.gemmVocab). Only one chunk at a time is converted to
+    floats. For uint8 descriptors and vocabulary every intermediate value
+    is an integer no larger than |v|^2 or 2 |d| |v|; a chunk that keeps
+    those below 2^24 is computed in float32, which holds such integers
+    exactly, so the words are those vq picks, including the lowest index
+    winning a tie. SIFT-normalized PHOW descriptors always do (|d|^2 is
+    about 512^2 at most per 128 dimensions), but arbitrary uint8 data need
+    not; such chunks are computed in float64, as is everything with a
+    float vocabulary (from an older vocab file, say).
+    """
+    exact = descrs.dtype == numpy.uint8 and model.vocab.dtype == numpy.uint8
+    if exact:
+        # Summed in float32, but partial sums only grow, so this is exact
+        # whenever it comes out below 2^24
+        wordNorm = float(model.gemmVocab('float32')[1].max())
+        exact = wordNorm < 2 ** 24
+    words = numpy.empty(descrs.shape[1], 'intp')
+    for start in range(0, descrs.shape[1], chunkSize):
+        chunk = descrs[:, start:start + chunkSize].T
+        dtype = 'float64'
+        if exact:
+            chunk = numpy.asarray(chunk, 'float32')
+            descrNorm = numpy.einsum('ij,ij->i', chunk, chunk, dtype='float64').max()
+            if 4 * descrNorm * wordNorm < 2.0 ** 48:
+                dtype = 'float32'
+        vocab, norms = model.gemmVocab(dtype)
+        chunk = numpy.asarray(chunk, dtype)
+        scores = numpy.dot(chunk, vocab)
+        scores *= -2
+        scores += norms
+        words[start:start + chunkSize] = scores.argmin(axis=1)
+    return words
+
+
+def quantizeDescriptorsBatch(model, descrsList):
+    """ quantizeDescriptors for the descriptors of several images at once
+
+    With the gemm quantizer the descriptors are stacked so that the whole
+    batch goes through the same large matrix products; the words are
+    split back per image.
+    """
+    if model.quantizer != 'gemm' or len(descrsList) < 2:
+        return [quantizeDescriptors(model, descrs) for descrs in descrsList]
+    words = quantizeDescriptors(model, hstack(descrsList))
+    splits = numpy.cumsum([descrs.shape[1] for descrs in descrsList])[:-1]
+    return numpy.split(words, splits)
+
+
+def _nearestCell(coords, extent, numCells):
+    # Index of the nearest of numCells centres spread evenly over
+    # [0, extent], i.e. vq(coords, linspace(0, extent, numCells)) with ties
+    # going to the lower cell as vq does
+    if numCells == 1:
+        return numpy.zeros(len(coords), 'intp')
+    cells = numpy.ceil(coords * ((numCells - 1) / float(extent)) - 0.5)
+    return numpy.clip(cells, 0, numCells - 1).astype('intp')
+
+
+@birdid_stats.timed('pyramid')
+def getSpatialHistogram(frames, words, width, height, numWords, numSpatialX,
+                        sparse=False):
+    """ Spatial pyramid histogram of the visual words of one image
+
+    The bin of every descriptor at every pyramid level is computed
+    arithmetically and all levels are counted with a single bincount. Each
+    level sums to one over its descriptors and the levels are weighted
+    equally, matching the old per-level numpy.histogram construction.
+    numSpatialY is not needed because it must equal numSpatialX.
+
+    With sparse, the histogram is a 1-row scipy.sparse CSR matrix holding
+    only the non-empty bins.
+    """
+    numSpatialX = ensure_type_array(numSpatialX)
+    words = numpy.asarray(words, 'intp')
+    bins = []
+    offset = 0
+    for numCells in numSpatialX:
+        binsx = _nearestCell(frames[0, :], width, numCells)
+        binsy = _nearestCell(frames[1, :], height, numCells)
+        bins.append(offset + (binsx * numCells + binsy) * numWords + words)
+        offset += numCells * numCells * numWords
+    bins = numpy.concatenate(bins)
+    if sparse:
+        from scipy.sparse import csr_matrix
+        hist = csr_matrix((numpy.ones(len(bins), 'float32'), bins, [0, len(bins)]),
+                          shape=(1, offset))
+        hist.sum_duplicates()
+        hist.data /= len(words) * len(numSpatialX)
+        return hist
+    counts = numpy.bincount(bins, minlength=offset)
+    return array(counts, 'float32') / (len(words) * len(numSpatialX))
+
+
+def matchHistogramFormat(model, hist):
+    """ hist as a dense vector or a CSR row, whichever model produces """
+    if model.sparseHistograms and not isSparse(hist):
+        from scipy.sparse import csr_matrix
+        return csr_matrix(hist.reshape(1, -1))
+    if not model.sparseHistograms and isSparse(hist):
+        return hist.toarray().ravel()
+    return hist
+
+
+def stackHistograms(hists):
+    """ vstack for a list of dense or CSR histograms """
+    if len(hists) and isSparse(hists[0]):
+        from scipy.sparse import vstack as sparse_vstack
+        return sparse_vstack(hists, format='csr')
+    return vstack(hists)
+
+
+def getImageFeatures(im, conf):
+    """ PHOW frames and descriptors of an image with its standardized size """
+    im = standardizeImage(im)
+    height, width = im.shape[:2]
+    frames, descrs = getPhowFeatures(im, conf.phowOpts)
+    birdid_stats.count('features')
+    birdid_stats.count('descriptors', descrs.shape[1])
+    return frames, descrs, width, height
+
+
+def getFeatureHistogram(model, frames, descrs, width, height):
+    numWords = model.vocab.shape[1]
+    # quantize appearance
+    words = quantizeDescriptors(model, descrs) #slowest function - nearest visual word search
+    return getSpatialHistogram(frames, words, width, height, numWords,
+                               model.numSpatialX, model.sparseHistograms)
+
+
 def getImageDescriptor(model, im, conf):
-	im = standardizeImage(im)
-	height, width = im.shape[:2]
-	numWords = model.vocab.shape[1]
-	frames, descrs = getPhowFeatures(im, conf.phowOpts)
-	# quantize appearance
-	if model.quantizer == 'vq':
-		binsa, _ = vq(descrs.T, model.vocab.T)
-	elif model.quantizer == 'kdtree':
-		raise ValueError('quantizer kdtree not implemented')
-	else:
-		raise ValueError('quantizer {0} not known or understood'.format(model.quantizer))
-	hist = []
-	for n_spatial_bins_x, n_spatial_bins_y in zip(model.numSpatialX, model.numSpatialX):
-		binsx, distsx = vq(frames[0, :], linspace(0, width, n_spatial_bins_x))
-		binsy, distsy = vq(frames[1, :], linspace(0, height, n_spatial_bins_y))
-		# binsx and binsy list to what spatial bin each feature point belongs to
-		if (numpy.any(distsx < 0)) | (numpy.any(distsx > (width/n_spatial_bins_x+0.5))):
-			print ("something went wrong")
-			import pdb; pdb.set_trace()
-		if (numpy.any(distsy < 0)) | (numpy.any(distsy > (height/n_spatial_bins_y+0.5))):
-			print ("something went wrong")
-			import pdb; pdb.set_trace()
-		# combined quantization
-		number_of_bins = n_spatial_bins_x * n_spatial_bins_y * numWords
-		temp = arange(number_of_bins)
-		# update using this: http://stackoverflow.com/questions/15230179/how-to-get-the-linear-index-for-a-numpy-array-sub2ind
-		temp = temp.reshape([n_spatial_bins_x, n_spatial_bins_y, numWords])
-		bin_comb = temp[binsx, binsy, binsa]
-		hist_temp, _ = histogram(bin_comb, bins=range(number_of_bins+1), density=True)
-		hist.append(hist_temp)
-	
-	hist = hstack(hist)
-	hist = array(hist, 'float32') / sum(hist)
-	return hist
-
-def getImageDescriptorMulti(model, im, idx, conf): #gets histograms
-	im = standardizeImage(im) #scale image to 640x480
-	height, width = im.shape[:2]
-	numWords = model.vocab.shape[1]
-	frames, descrs = getPhowFeatures(im, conf.phowOpts) #extract features
-	# quantize appearance
-	if model.quantizer == 'vq':
-		binsa, _ = vq(descrs.T, model.vocab.T) #slowest function - does kmeans clustering
-	elif model.quantizer == 'kdtree':
-		raise ValueError('quantizer kdtree not implemented')
-	else:
-		raise ValueError('quantizer {0} not known or understood'.format(model.quantizer))
-	hist = []
-	#generate the histogram bins
-	for n_spatial_bins_x, n_spatial_bins_y in zip(model.numSpatialX, model.numSpatialX):
-		binsx, distsx = vq(frames[0, :], linspace(0, width, n_spatial_bins_x))
-		binsy, distsy = vq(frames[1, :], linspace(0, height, n_spatial_bins_y))
-		# binsx and binsy list to what spatial bin each feature point belongs to
-		if (numpy.any(distsx < 0)) | (numpy.any(distsx > (width/n_spatial_bins_x+0.5))):
-			print ("something went wrong")
-			import pdb; pdb.set_trace()
-		if (numpy.any(distsy < 0)) | (numpy.any(distsy > (height/n_spatial_bins_y+0.5))):
-			print ("something went wrong")
-			import pdb; pdb.set_trace()
-		# combined quantization
-		number_of_bins = n_spatial_bins_x * n_spatial_bins_y * numWords
-		temp = arange(number_of_bins)
-		# update using this: http://stackoverflow.com/questions/15230179/how-to-get-the-linear-index-for-a-numpy-array-sub2ind
-		temp = temp.reshape([n_spatial_bins_x, n_spatial_bins_y, numWords])
-		bin_comb = temp[binsx, binsy, binsa]
-		hist_temp, _ = histogram(bin_comb, bins=range(number_of_bins+1), density=True) #generate histogram
-		hist.append(hist_temp)
-	
-	hist = hstack(hist)
-	hist = array(hist, 'float32') / sum(hist)
-	numTot = float(conf.numClasses*(conf.numTrain+conf.numTest))
-	sys.stdout.write ("\r"+str(datetime.now())+" Histograms Calculated: "+str(((idx+1)/numTot)*100.0)[:5]+"%") #make progress percentage
-	sys.stdout.flush()
-	return [idx, hist]
+    return getFeatureHistogram(model, *getImageFeatures(im, conf))
+
+
+def getImageHistograms(model, ims, conf):
+    """ getImageDescriptor for several images, quantized in one batch """
+    features = [getImageFeatures(im, conf) for im in ims]
+    words = quantizeDescriptorsBatch(model, [descrs for _, descrs, _, _ in features])
+    numWords = model.vocab.shape[1]
+    return [getSpatialHistogram(frames, imageWords, width, height, numWords,
+                                model.numSpatialX, model.sparseHistograms)
+            for (frames, _, width, height), imageWords in zip(features, words)]
+
+
+def getCachedImageDescriptor(model, imagefname, conf, cache):
+    """ getImageDescriptor for an image file, looked up in cache first
+
+    cache is a birdid_cache.HistogramCache. When it also keeps descriptors,
+    a histogram miss can still skip PHOW extraction.
+    """
+    hist = cache.getHistogram(imagefname)
+    if hist is None:
+        features = cache.getFeatures(imagefname)
+        if features is None:
+            features = getImageFeatures(loadImage(imagefname), conf)
+            cache.putFeatures(imagefname, features)
+        hist = getFeatureHistogram(model, *features)
+        cache.putHistogram(imagefname, hist)
+    return matchHistogramFormat(model, hist)
+
+
+def getImageDescriptorMulti(model, im, idx, conf, numImages=None):
+    # numImages is the number of images being processed; the training
+    # constants numClasses*(numTrain+numTest) say nothing about a folder
+    # being classified, so without it only the count is shown
+    hist = getImageDescriptor(model, im, conf)
+    if numImages:
+        done = str(((idx+1)/float(numImages))*100.0)[:5]+"%"
+    else:
+        done = str(idx+1)
+    sys.stderr.write ("\r"+str(datetime.now())+" Histograms Calculated: "+done) #make progress percentage
+    sys.stderr.flush()
+    return [idx, hist]
 
 def trainVocab(selTrain, all_images, conf):
 	selTrainFeats = sample(selTrain, conf.images_for_histogram)
+	method = getattr(conf, 'vocabMethod', 'ikmeans')
+	if method != 'ikmeans':
+		return trainVocabStreaming([all_images[i] for i in selTrainFeats], conf, method)
 	descrs = []
 	for i in selTrainFeats:
-		im = imread(all_images[i])
+		im = loadImage(all_images[i])
 		descrs.append(getPhowFeatures(im, conf.phowOpts)[1])
 	# the '[1]' is there because we only want the descriptors and not the frames
     
@@ -219,12 +458,119 @@ def trainVocab(selTrain, all_images, conf):
 	descrs = array(descrs, 'uint8')
     
     # Quantize the descriptors to get the visual words
+	from vlfeat import vl_ikmeans
 	vocab, _ = vl_ikmeans(descrs,
                           K=conf.numWords,
                           verbose=conf.verbose,
                           method='elkan')
 	return vocab
 
+def getTrainingDescriptors(im, conf):
+    """ PHOW descriptors of an image as uint8, the type trainVocab clusters """
+    return array(getPhowFeatures(im, conf.phowOpts)[1], 'uint8')
+
+
+def iterDescriptors(all_images, conf):
+    """ Yield getTrainingDescriptors of each image file, on conf.numCore processes """
+    if conf.numCore > 1:
+        for descrs in iterDescriptorsMulti(all_images, conf):
+            yield descrs
+    else:
+        for imagefname in all_images:
+            yield getTrainingDescriptors(loadImage(imagefname), conf)
+
+
+class DescriptorReservoir(object):
+    """ Uniform random sample of at most size descriptors from a stream
+
+    Reservoir sampling (Vitter's algorithm R), applied a whole image of
+    descriptors at a time: after add has been given n descriptors in
+    total, every one of them is in sample with probability size / n,
+    while only size of them are ever held.
+    """
+
+    def __init__(self, size, rng=None):
+        self.size = size
+        self.rng = rng if rng is not None else numpy.random.RandomState()
+        self.sample = None
+        self.filled = 0
+        self.seen = 0
+
+    def add(self, descrs):
+        if self.sample is None:
+            self.sample = numpy.empty((descrs.shape[0], self.size), descrs.dtype)
+        count = descrs.shape[1]
+        # The first descriptors fill the reservoir
+        take = min(count, self.size - self.filled)
+        self.sample[:, self.filled:self.filled + take] = descrs[:, :take]
+        self.filled += take
+        # Descriptor number t (1-based) of the stream replaces a random
+        # slot with probability size / t
+        positions = self.seen + numpy.arange(take + 1, count + 1)
+        slots = (self.rng.random_sample(len(positions)) * positions).astype('int64')
+        keep = slots < self.size
+        # In stream order, so a later descriptor overwrites an earlier one
+        # drawn for the same slot, as the sequential algorithm would
+        self.sample[:, slots[keep]] = descrs[:, take:][:, keep]
+        self.seen += count
+
+    def descriptors(self):
+        return self.sample[:, :self.filled]
+
+
+def trainVocabStreaming(all_images, conf, method='reservoir'):
+    """ Visual words from the descriptors of all_images, at bounded memory
+
+    Descriptors are extracted on conf.numCore processes; besides the
+    sample or batch being built, only those of the up to 2 * conf.numCore
+    images in flight are held. method 'reservoir' runs vl_ikmeans on a
+    uniform sample of conf.numbers_of_features_for_histogram of them, as
+    trainVocab does without keeping every descriptor first; 'minibatch'
+    runs sklearn's MiniBatchKMeans over all of them, conf.vocabBatchSize at
+    a time, so many more images can be used. Returns a uint8 vocab, one
+    column per word, like trainVocab.
+    """
+    rng = numpy.random.RandomState(conf.randSeed)
+    if method == 'reservoir':
+        reservoir = DescriptorReservoir(conf.numbers_of_features_for_histogram, rng)
+        for descrs in iterDescriptors(all_images, conf):
+            reservoir.add(descrs)
+        from vlfeat import vl_ikmeans
+        vocab, _ = vl_ikmeans(reservoir.descriptors(),
+                              K=conf.numWords,
+                              verbose=conf.verbose,
+                              method='elkan')
+        return array(vocab, 'uint8')
+    elif method == 'minibatch':
+        from sklearn.cluster import MiniBatchKMeans
+        batchSize = getattr(conf, 'vocabBatchSize', 10000)
+        kmeans = MiniBatchKMeans(n_clusters=conf.numWords, batch_size=batchSize,
+                                 random_state=rng)
+        # The first batch initializes the centres, so give it a few
+        # descriptors per word
+        needed = max(batchSize, 3 * conf.numWords)
+        batch = []
+        batchLength = 0
+        for descrs in iterDescriptors(all_images, conf):
+            batch.append(descrs)
+            batchLength += descrs.shape[1]
+            if batchLength >= needed:
+                kmeans.partial_fit(array(hstack(batch).T, 'float32'))
+                batch = []
+                batchLength = 0
+                needed = batchSize
+        if batch and (batchLength >= conf.numWords or
+                      getattr(kmeans, 'cluster_centers_', None) is not None):
+            kmeans.partial_fit(array(hstack(batch).T, 'float32'))
+        if getattr(kmeans, 'cluster_centers_', None) is None:
+            raise ValueError('{0} descriptors are too few for {1} words'.format(
+                batchLength, conf.numWords))
+        centres = numpy.clip(numpy.rint(kmeans.cluster_centers_.T), 0, 255)
+        return array(centres, 'uint8')
+    else:
+        raise ValueError('vocabulary method {0} not known or understood'.format(method))
+
+
 class Model(object):
     def __init__(self, classes, conf, vocab=None):
         self.classes = classes
@@ -232,8 +578,47 @@ class Model(object):
         self.numSpatialX = conf.numSpatialX
         self.numSpatialY = conf.numSpatialY
         self.quantizer = conf.quantizer
+        # configurations pickled before kdtreeEps existed search exactly
+        self.kdtreeEps = getattr(conf, 'kdtreeEps', 0.0)
+        self.quantizeBatch = getattr(conf, 'quantizeBatch', 8)
+        # produce scipy.sparse CSR rows instead of dense histograms
+        self.sparseHistograms = False
         self.vocab = vocab
 
+    def _getVocab(self):
+        return self._vocab
+
+    def _setVocab(self, vocab):
+        self._vocab = vocab
+        self._kdtree = None
+        self._gemm = {}
+
+    # Assigning a new vocabulary drops the search structures built for the
+    # old one
+    vocab = property(_getVocab, _setVocab)
+
+    def gemmVocab(self, dtype):
+        """ Vocabulary and squared word norms as dtype, built once """
+        if dtype not in self._gemm:
+            vocab = numpy.ascontiguousarray(self.vocab, dtype)
+            self._gemm[dtype] = (vocab, (vocab * vocab).sum(axis=0))
+        return self._gemm[dtype]
+
+    def kdtree(self):
+        """ KD-tree over the visual words, built once per vocabulary """
+        if self._kdtree is None:
+            from scipy.spatial import cKDTree
+            self._kdtree = cKDTree(array(self.vocab.T, 'float64'))
+        return self._kdtree
+
+    def __getstate__(self):
+        # Pool workers rebuild the tree and the gemm vocabulary themselves
+        # instead of unpickling them
+        state = self.__dict__.copy()
+        state['_kdtree'] = None
+        state['_gemm'] = {}
+        return state
+
 
 class SVMParameters(object):
     def __init__(self, C):
@@ -241,10 +626,14 @@ class SVMParameters(object):
 
 
 class PHOWOptions(object):
-    def __init__(self, Verbose, Sizes, Step):
+    def __init__(self, Verbose, Sizes, Step, MaxDescriptors=None):
         self.Verbose = Verbose
         self.Sizes = Sizes
         self.Step = Step
+        # Descriptor budget per image (None for no limit). It is part of the
+        # pickled configuration, so classification adapts exactly as
+        # training did
+        self.MaxDescriptors = MaxDescriptors
 
 
 def get_classes(datasetpath, numClasses):
@@ -269,7 +658,20 @@ def get_imgfiles(path, extensions):
     return all_files
 
 
+def nativeStr(text):
+    """ text as the str that get_imgfiles lists paths as
+
+    JSON gives back unicode; on Python 2 that is encoded as UTF-8 so it
+    compares equal to the listed (byte string) path.
+    """
+    if not isinstance(text, str):
+        text = text.encode('utf-8')
+    return text
+
+
 def showconfusionmatrix(cm):
+    # pylab brings up a GUI backend, so only load it when plotting
+    import pylab as pl
     pl.matshow(cm)
     pl.title('Confusion matrix')
     pl.colorbar()
@@ -317,25 +719,181 @@ def create_split_n(all_images, imgsPerClass, numTrain):
 
     return selTrain, selTest
 
-def computeHistograms(all_images, model, conf):
-	hists = []
-	for ii, imagefname in enumerate(all_images):
-		im = imread(imagefname)
-		hists_temp = getImageDescriptor(model, im, conf)
-		hists.append(hists_temp)
-	hists = vstack(hists)
+def histogramLength(model):
+    """ Number of bins in the spatial histogram of one image """
+    numWords = model.vocab.shape[1]
+    return int(sum(n * n for n in ensure_type_array(model.numSpatialX)) * numWords)
+
+
+def openHistogramStore(path, numImages, model, mode='w+'):
+    """ On-disk float32 array with one histogram row per image
+
+    Pass it (or a slice of rows) as out to computeHistograms so that the
+    histograms of a large folder never have to fit in memory together.
+    """
+    return numpy.memmap(path, dtype='float32', mode=mode,
+                        shape=(numImages, histogramLength(model)))
+
+
+@birdid_stats.timed('histograms')
+def computeHistograms(all_images, model, conf, cache=None, progress=None, out=None):
+	# progress, if given, is called with the number of images done so far
+	# after each image; an exception raised from it stops the computation.
+	# With out, e.g. from openHistogramStore, row ii of out receives the
+	# histogram of image ii and out is returned
+	hists = [None] * len(all_images) if out is None else out
+	birdid_stats.count('images', len(all_images))
+	if cache is None and model.quantizer == 'gemm' and model.quantizeBatch > 1:
+		# Quantize the descriptors of several images at once
+		batchSize = model.quantizeBatch
+		for start in range(0, len(all_images), batchSize):
+			ims = [loadImage(imagefname) for imagefname in all_images[start:start + batchSize]]
+			for ii, hists_temp in enumerate(getImageHistograms(model, ims, conf), start):
+				hists[ii] = hists_temp
+				if progress is not None:
+					progress(ii + 1)
+	else:
+		for ii, imagefname in enumerate(all_images):
+			if cache is None:
+				hists_temp = getImageDescriptor(model, loadImage(imagefname), conf)
+			else:
+				hists_temp = getCachedImageDescriptor(model, imagefname, conf, cache)
+			hists[ii] = hists_temp
+			if progress is not None:
+				progress(ii + 1)
+	if out is not None:
+		return out
+	hists = stackHistograms(hists)
 	return hists
 
-def computeHistogramsMulti(all_images, model, conf):
-	hists = []
-	#start multiprocessing block
-	pool = multiprocessing.Pool(processes=conf.numCore)
-	results = [pool.apply_async(getImageDescriptorMulti, args=(model, imread(imagefname), ii, conf)) for ii, imagefname in enumerate(all_images)]
-	hists = [p.get() for p in results]
-	sorted(hists)
-	for hist in hists:
-		hist.pop(0)
-	#end multiprocessing block
-	hists = vstack(hists)
-	print "" #puts in a new line to separate histogram percentage
-	return hists
+# Per-worker state, set once by _initHistogramWorker so the model and
+# configuration are not pickled along with every image
+_workerModel = None
+_workerConf = None
+
+
+def _initHistogramWorker(model, conf, stats):
+    global _workerModel, _workerConf
+    _workerModel = model
+    _workerConf = conf
+    if stats:
+        birdid_stats.enable()
+
+
+def _histogramWorker(imagefname):
+    # The worker's stage times travel back with each histogram
+    with birdid_stats.stage('worker'):
+        hist = getImageDescriptor(_workerModel, loadImage(imagefname), _workerConf)
+    return hist, birdid_stats.collect()
+
+
+def _descriptorWorker(imagefname):
+    with birdid_stats.stage('worker'):
+        descrs = getTrainingDescriptors(loadImage(imagefname), _workerConf)
+    return descrs, birdid_stats.collect()
+
+
+def openHistogramPool(model, conf):
+    """ Worker pool for iterHistogramsMulti that can be reused across calls
+
+    Workers record stage times if birdid_stats is enabled when the pool
+    is opened.
+    """
+    import multiprocessing
+    return multiprocessing.Pool(processes=conf.numCore,
+                                initializer=_initHistogramWorker,
+                                initargs=(model, conf,
+                                          birdid_stats.current() is not None))
+
+
+def iterHistogramsMulti(all_images, model, conf, maxInFlight=None, pool=None):
+    """ Yield the histogram of each image, in input order
+
+    Workers receive file names and decode the images themselves. At most
+    maxInFlight images (default twice the number of workers) are queued or
+    finished but not yet consumed, so memory use does not grow with the
+    number of images.
+
+    pool, from openHistogramPool with the same model, is used as is and
+    left running; otherwise a pool is started and torn down for this call.
+    """
+    return _iterWorkerResults(_histogramWorker, all_images, model, conf,
+                              maxInFlight, pool)
+
+
+def iterDescriptorsMulti(all_images, conf, maxInFlight=None, pool=None):
+    """ Yield the uint8 PHOW descriptors of each image, in input order
+
+    Works like iterHistogramsMulti; pool comes from openHistogramPool(None, conf).
+    """
+    return _iterWorkerResults(_descriptorWorker, all_images, None, conf,
+                              maxInFlight, pool)
+
+
+def _iterWorkerResults(worker, all_images, model, conf, maxInFlight, pool):
+    if maxInFlight is None:
+        maxInFlight = 2 * conf.numCore
+    ownPool = pool is None
+    if ownPool:
+        pool = openHistogramPool(model, conf)
+    began = time.time()
+    try:
+        pending = deque()
+        for imagefname in all_images:
+            pending.append(pool.apply_async(worker, (imagefname,)))
+            if len(pending) >= maxInFlight:
+                result, stats = pending.popleft().get()
+                birdid_stats.merge(stats)
+                yield result
+        while pending:
+            result, stats = pending.popleft().get()
+            birdid_stats.merge(stats)
+            yield result
+    finally:
+        # Worker seconds available, against which the 'worker' stage
+        # gives the utilization of the pool
+        birdid_stats.count('pool_seconds', conf.numCore * (time.time() - began))
+        if ownPool:
+            pool.terminate()
+            pool.join()
+
+
+@birdid_stats.timed('histograms')
+def computeHistogramsMulti(all_images, model, conf, cache=None, progress=None,
+                           pool=None, out=None):
+    # Only cache misses are sent to the workers. progress and out work as
+    # for computeHistograms; cache hits count as done up front
+    hists = [None] * len(all_images) if out is None else out
+    birdid_stats.count('images', len(all_images))
+    missing = []
+    for ii, imagefname in enumerate(all_images):
+        hist = None if cache is None else cache.getHistogram(imagefname)
+        if hist is None:
+            missing.append(ii)
+        else:
+            hists[ii] = matchHistogramFormat(model, hist)
+    missingFiles = [all_images[ii] for ii in missing]
+    numTot = float(len(missing))
+    numCached = len(all_images) - len(missing)
+    if progress is not None and numCached:
+        progress(numCached)
+    for done, hist in enumerate(iterHistogramsMulti(missingFiles, model, conf,
+                                                    pool=pool)):
+        ii = missing[done]
+        hists[ii] = hist
+        if cache is not None:
+            cache.putHistogram(all_images[ii], hist)
+        if progress is not None:
+            progress(numCached + done + 1)
+        else:
+            # stderr, so that stdout stays free for the output of the
+            # command line tools
+            sys.stderr.write("\r" + str(datetime.now()) + " Histograms Calculated: " +
+                             str(((done + 1) / numTot) * 100.0)[:5] + "%")
+            sys.stderr.flush()
+    if progress is None and missing:
+        sys.stderr.write("\n") #puts in a new line to separate histogram percentage
+    if out is not None:
+        return out
+    hists = stackHistograms(hists)
+    return hists
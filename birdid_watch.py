@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+""" Classify images as they arrive in a folder
+
+The cameras drop images into the input folder all day. Instead of
+classifying the whole folder on every run, watch keeps a ledger of the
+files it has classified and only picks up new or changed ones:
+
+    python birdid_watch.py MODELDIR IDENTIFIER PREFIX INPUTDIR OUTPUTDIR
+
+The ledger is a JSON lines file (INPUTDIR/.birdid-ledger.jsonl by default)
+with one record per classified file: path, size, mtime, predicted class
+and the fingerprint of the model that predicted it. A file is classified
+again if its size or mtime changes or if the model does. The folder is
+polled with get_imgfiles, which works the same on network shares where
+inotify does not see remote writes. --once makes a single pass, e.g. from
+cron.
+"""
+
+import argparse
+import json
+import sys
+import time
+from datetime import datetime
+from os import fsync, rename, stat
+from os.path import abspath, exists, join
+from birdid_utils import get_imgfiles, loadImage, nativeStr
+from birdid_classify import Classifier, classifyImages, printStatus, \
+    addStatsArguments, writeStats, classifierFingerprint
+import birdid_stats
+from birdid_placement import PLACEMENT_MODES, COLLISION_POLICIES
+
+
+class Ledger(object):
+    """ Append-only record of the files that have been classified
+
+    Later records for a path replace earlier ones when the file is read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        lines = 0
+        if exists(path):
+            with open(path) as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # cut short by a crash
+                    entry['path'] = nativeStr(entry['path'])
+                    self.entries[entry['path']] = entry
+                    lines += 1
+        if lines > 2 * len(self.entries) + 1000:
+            self.compact()
+
+    def isCurrent(self, imagefname, info, fingerprint):
+        entry = self.entries.get(abspath(imagefname))
+        return (entry is not None and entry['size'] == info.st_size and
+                entry['mtime'] == info.st_mtime and
+                entry['fingerprint'] == fingerprint)
+
+    def record(self, entries):
+        """ Add entries, and make sure they are on disk before returning """
+        with open(self.path, 'a') as fp:
+            for entry in entries:
+                fp.write(json.dumps(entry, sort_keys=True) + '\n')
+            fp.flush()
+            fsync(fp.fileno())
+        for entry in entries:
+            self.entries[nativeStr(entry['path'])] = entry
+
+    def compact(self):
+        # Rewrite with one record per path; rename so a crash halfway
+        # leaves the old ledger in place
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as fp:
+            for path in sorted(self.entries):
+                fp.write(json.dumps(self.entries[path], sort_keys=True) + '\n')
+            fp.flush()
+            fsync(fp.fileno())
+        rename(temp, self.path)
+
+
+def pendingImages(inputDir, extensions, ledger, fingerprint, settle=2.0):
+    """ Files in inputDir the ledger has no current record of, oldest first
+
+    Files modified less than settle seconds ago may still be being written
+    by the camera and are left for a later poll.
+    """
+    now = time.time()
+    pending = []
+    for imagefname in get_imgfiles(inputDir, extensions):
+        try:
+            info = stat(imagefname)
+        except OSError:
+            continue  # moved away since the glob
+        if now - info.st_mtime < settle:
+            continue
+        if not ledger.isCurrent(imagefname, info, fingerprint):
+            pending.append((info.st_mtime, imagefname, info))
+    pending.sort()
+    return [(imagefname, info) for _, imagefname, info in pending]
+
+
+def _quiet(message):
+    pass
+
+
+def readError(imagefname):
+    """ repr of why imagefname can't be loaded as an image, None if it can
+
+    Loaded the way classification does, so images that decode but are
+    then rejected (an all-black frame, say) count as unreadable too.
+    """
+    try:
+        loadImage(imagefname)
+    except Exception as e:
+        return repr(e)
+    return None
+
+
+class Watcher(object):
+    """ Classifies the new arrivals in a folder in micro-batches """
+
+    def __init__(self, classifier, inputDir, destFolder, ledgerPath=None,
+                 batchSize=16, settle=2.0, jobs=1, cache=None,
+                 placement='copy', collision='overwrite', status=printStatus):
+        self.classifier = classifier
+        self.inputDir = inputDir
+        self.destFolder = destFolder
+        self.ledger = Ledger(ledgerPath or join(inputDir, '.birdid-ledger.jsonl'))
+        self.fingerprint = classifierFingerprint(classifier)
+        self.batchSize = batchSize
+        self.settle = settle
+        self.jobs = jobs
+        self.cache = cache
+        self.placement = placement
+        self.collision = collision
+        self.status = status
+        self.imagesClassified = 0
+        self.batches = 0
+
+    def poll(self):
+        """ Classify everything currently pending; returns how many images """
+        pending = pendingImages(self.inputDir, self.classifier.conf.extensions,
+                                self.ledger, self.fingerprint, self.settle)
+        for start in range(0, len(pending), self.batchSize):
+            self._classifyBatch(pending[start:start + self.batchSize])
+        return len(pending)
+
+    def _classifyBatch(self, batch):
+        began = time.time()
+        imgs = [imagefname for imagefname, _ in batch]
+        try:
+            predicted, _ = classifyImages(self.classifier, imgs, self.destFolder,
+                                          jobs=self.jobs, cache=self.cache,
+                                          status=_quiet,
+                                          placement=self.placement,
+                                          collision=self.collision)
+            errors = [None] * len(imgs)
+        except Exception as e:
+            if len(batch) > 1:
+                # Don't hold up the batch for one unreadable image
+                for item in batch:
+                    self._classifyBatch([item])
+                return
+            error = readError(imgs[0])
+            if error is None:
+                # Not the image's fault (a full or unmounted destination,
+                # permissions, ...): leave it pending for the next poll
+                self.status(str(datetime.now()) + ' Could not classify ' +
+                            imgs[0] + ', will retry: ' + repr(e))
+                return
+            predicted, errors = [None], [error]
+        finished = time.time()
+
+        entries = []
+        for (imagefname, info), classIndex, error in zip(batch, predicted, errors):
+            entry = {'path': abspath(imagefname), 'size': info.st_size,
+                     'mtime': info.st_mtime, 'fingerprint': self.fingerprint,
+                     'time': finished}
+            if error is None:
+                entry['class'] = str(self.classifier.classes[classIndex])
+            else:
+                # The image itself can't be read; recorded so it isn't
+                # retried until the file changes
+                entry['error'] = error
+                self.status(str(datetime.now()) + ' Could not classify ' +
+                            imagefname + ': ' + error)
+            entries.append(entry)
+        self.ledger.record(entries)
+
+        self.batches += 1
+        self.imagesClassified += len(batch)
+        # Latency is from the moment the oldest file of the batch was last
+        # written to the moment it was placed
+        oldest = min(info.st_mtime for _, info in batch)
+        self.status(str(datetime.now()) + ' Batch of {0} images in {1:.2f} s, '
+                    'latency {2:.1f} s'.format(len(batch), finished - began,
+                                               finished - oldest))
+
+    def run(self, interval=5.0, once=False, afterPoll=None):
+        """ Poll every interval seconds; afterPoll(images) is called after each """
+        while True:
+            began = time.time()
+            images = self.poll()
+            if afterPoll is not None:
+                afterPoll(images)
+            if once:
+                return
+            time.sleep(max(0.0, interval - (time.time() - began)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('modelDir', help='directory containing the model files')
+    parser.add_argument('identifier', help='model identifier')
+    parser.add_argument('prefix', help='model prefix')
+    parser.add_argument('inputDir', help='directory the images arrive in')
+    parser.add_argument('outputDir', help='directory for the per-class folders')
+    parser.add_argument('--ledger',
+                        help='ledger file, INPUTDIR/.birdid-ledger.jsonl by default')
+    parser.add_argument('--interval', type=float, default=5.0,
+                        help='seconds between polls')
+    parser.add_argument('--settle', type=float, default=2.0,
+                        help='leave files modified less than this many seconds ago')
+    parser.add_argument('--batch-size', type=int, default=16,
+                        help='images per micro-batch')
+    parser.add_argument('--once', action='store_true',
+                        help='classify what is there now and exit')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='resident worker processes for feature extraction')
+    parser.add_argument('--cache-dir',
+                        help='keep image histograms in this directory')
+    parser.add_argument('--place', choices=PLACEMENT_MODES, default='copy',
+                        help='how images get into the class folders')
+    parser.add_argument('--on-collision', choices=COLLISION_POLICIES,
+                        default='overwrite',
+                        help='what to do when the destination name exists')
+    addStatsArguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.stats:
+        birdid_stats.enable()
+    classifier = Classifier(args.modelDir, args.identifier, args.prefix,
+                            status=printStatus)
+    if args.jobs > 1:
+        # Keep the workers alive between polls
+        classifier.startPool(args.jobs)
+    cache = classifier.openCache(args.cache_dir) if args.cache_dir else None
+    watcher = Watcher(classifier, args.inputDir, args.outputDir, args.ledger,
+                      args.batch_size, args.settle, args.jobs, cache,
+                      args.place, args.on_collision)
+    printStatus(str(datetime.now()) + ' Watching ' + args.inputDir)
+    try:
+        # Refresh the stats after every poll that found something, so a
+        # Prometheus text file is current while the watcher keeps running
+        watcher.run(args.interval, args.once,
+                    None if args.once else lambda images: images and writeStats(args))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        classifier.stopPool()
+    printStatus(str(datetime.now()) + ' Classified {0} images in {1} batches'.format(
+        watcher.imagesClassified, watcher.batches))
+    writeStats(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
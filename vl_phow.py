@@ -1,6 +1,9 @@
-from scipy import shape, dstack, sqrt, floor, array, mean, ones, vstack, hstack, ndarray
+from numpy import shape, dstack, sqrt, floor, array, mean, ones, vstack, hstack, ndarray
+from numpy import array_equal, empty, result_type
 from vlfeat import vl_rgb2gray, vl_imsmooth, vl_dsift
 from sys import maxint
+from time import time
+import birdid_stats
 
 """
 Python rewrite of https://github.com/vlfeat/vlfeat/blob/master/toolbox/sift/vl_phow.m
@@ -19,7 +22,14 @@ def vl_phow(im,
             floatdescriptors=False,
             magnif=6,
             windowsize=1.5,
-            contrastthreshold=0.005):
+            contrastthreshold=0.005,
+            fused=False):
+    """
+    fused=True gives identical output with less work: channels that are
+    copies of another (grayscale input) are smoothed and described once,
+    and the results are written straight into preallocated output arrays
+    instead of going through several array/vstack/hstack copies.
+    """
 
     opts = Options(verbose, fast, sizes, step, color, floatdescriptors,
                    magnif, windowsize, contrastthreshold)
@@ -65,6 +75,9 @@ def vl_phow(im,
         print('{0}: image size: {1} x {2}'.format('vl_phow', imageSize[0], imageSize[1]))
         print('{0}: sizes: [{1}]'.format('vl_phow', opts.sizes))
 
+    if fused:
+        return _phow_fused(im, opts, dsiftOpts, numChannels)
+
     frames_all = []
     descrs_all = []
     for size_of_spatial_bins in opts.sizes:
@@ -84,7 +97,8 @@ def vl_phow(im,
         # smooth the image to the appropriate scale based on the size
         # of the SIFT bins
         sigma = size_of_spatial_bins / float(opts.magnif)
-        ims = vl_imsmooth(im, sigma)
+        with birdid_stats.stage('phow_smooth'):
+            ims = vl_imsmooth(im, sigma)
 
         # extract dense SIFT features from all channels
         frames = []
@@ -92,13 +106,14 @@ def vl_phow(im,
         for k in range(numChannels):
             size_of_spatial_bins = int(size_of_spatial_bins)
             # vl_dsift does not accept numpy.int64 or similar
-            f_temp, d_temp = vl_dsift(data=ims[:, :, k],
-                                      step=dsiftOpts.step,
-                                      size=size_of_spatial_bins,
-                                      fast=dsiftOpts.fast,
-                                      verbose=dsiftOpts.verbose,
-                                      norm=dsiftOpts.norm,
-                                      bounds=[off, off, maxint, maxint])
+            with birdid_stats.stage('phow_dsift'):
+                f_temp, d_temp = vl_dsift(data=ims[:, :, k],
+                                          step=dsiftOpts.step,
+                                          size=size_of_spatial_bins,
+                                          fast=dsiftOpts.fast,
+                                          verbose=dsiftOpts.verbose,
+                                          norm=dsiftOpts.norm,
+                                          bounds=[off, off, maxint, maxint])
             frames.append(f_temp)
             descrs.append(d_temp)
         frames = array(frames)
@@ -128,6 +143,94 @@ def vl_phow(im,
     return frames_all, descrs_all
 
 
+def _phow_fused(im, opts, dsiftOpts, numChannels):
+    # source[k] is the first channel identical to channel k, so duplicated
+    # channels reuse its smoothing and dsift output
+    source = range(numChannels)
+    if im.ndim == 3:
+        for k in range(1, numChannels):
+            for j in range(k):
+                if source[j] == j and array_equal(im[:, :, k], im[:, :, j]):
+                    source[k] = j
+                    break
+    unique = [k for k in range(numChannels) if source[k] == k]
+    if im.ndim == 3 and len(unique) < im.shape[2]:
+        im = im[:, :, unique]
+
+    # dsift output of every scale, kept until the output size is known
+    scales = []
+    for size_of_spatial_bins in opts.sizes:
+        # see vl_phow above for the alignment of the different scales
+        off = floor(3.0 / 2 * (max(opts.sizes) - size_of_spatial_bins)) + 1
+        sigma = size_of_spatial_bins / float(opts.magnif)
+        with birdid_stats.stage('phow_smooth'):
+            ims = vl_imsmooth(im, sigma)
+        size_of_spatial_bins = int(size_of_spatial_bins)
+        results = {}
+        for position, k in enumerate(unique):
+            data = ims if ims.ndim == 2 else ims[:, :, position]
+            with birdid_stats.stage('phow_dsift'):
+                results[k] = vl_dsift(data=data,
+                                      step=dsiftOpts.step,
+                                      size=size_of_spatial_bins,
+                                      fast=dsiftOpts.fast,
+                                      verbose=dsiftOpts.verbose,
+                                      norm=dsiftOpts.norm,
+                                      bounds=[off, off, maxint, maxint])
+        scales.append((size_of_spatial_bins,
+                       [results[source[k]] for k in range(numChannels)]))
+
+    f_first, d_first = scales[0][1][0]
+    descrSize = d_first.shape[0]
+    numFrames = sum(channels[0][0].shape[1] for _, channels in scales)
+    frames_all = empty((4, numFrames), result_type(f_first.dtype, 'float64'))
+    descrs_all = empty((numChannels * descrSize, numFrames), d_first.dtype)
+
+    start = 0
+    for size_of_spatial_bins, channels in scales:
+        frames = [f for f, _ in channels]
+        stop = start + frames[0].shape[1]
+        block = descrs_all[:, start:stop]
+        for k, (_, d_temp) in enumerate(channels):
+            block[k * descrSize:(k + 1) * descrSize, :] = d_temp
+        # remove low contrast descriptors, thresholding the V component
+        # for color descriptors as vl_phow does
+        if (opts.color == 'gray') | (opts.color == 'opponent'):
+            contrast = frames[0][2, :]
+        elif opts.color == 'rgb':
+            contrast = mean([frames[0][2, :], frames[1][2, :], frames[2][2, :]], 0)
+        else:
+            raise ValueError('Color option ' + str(opts.color) + ' not recognized')
+        block[:, contrast < opts.contrastthreshold] = 0
+
+        # x, y, contrast of the first channel, and the scale
+        frames_all[0:3, start:stop] = frames[0][0:3, :]
+        frames_all[3, start:stop] = size_of_spatial_bins
+        start = stop
+
+    return frames_all, descrs_all
+
+
+def benchmark(im, repeats=5, sizes=[2, 4, 6, 8], step=3):
+    """ Seconds per image of vl_phow without and with fused=True
+
+    Also checks that both modes return identical frames and descriptors.
+    """
+    timings = []
+    outputs = []
+    for fused in (False, True):
+        began = time()
+        for _ in range(repeats):
+            output = vl_phow(im, verbose=False, sizes=sizes, step=step,
+                             fused=fused)
+        timings.append((time() - began) / repeats)
+        outputs.append(output)
+    if not (array_equal(outputs[0][0], outputs[1][0]) and
+            array_equal(outputs[0][1], outputs[1][1])):
+        raise AssertionError('fused vl_phow output differs')
+    return timings
+
+
 class Options(object):
     def __init__(self, verbose, fast, sizes, step, color,
                  floatdescriptors, magnif, windowsize,
@@ -155,6 +258,12 @@ class DSiftOptions(object):
         self.step = opts.step
 
 if __name__ == "__main__":
+    # python vl_phow.py [image] - time the default Sizes=[2,4,6,8], Step=3
+    import sys
     from scipy.misc import imread 
-    im = imread('image_0001.jpg')
-    frames, descrs = vl_phow(array(im, 'float32') / 255.0)    
+    imagefname = sys.argv[1] if len(sys.argv) > 1 else 'image_0001.jpg'
+    im = imread(imagefname)
+    for name, image in (('color', im), ('grayscale', imread(imagefname, flatten=True))):
+        plain, fused = benchmark(array(image, 'float32') / 255.0)
+        print('{0} {1}: {2:.3f} s per image, fused {3:.3f} s'.format(
+            imagefname, name, plain, fused))    